@@ -0,0 +1,413 @@
+#!/usr/bin/python3
+
+# benchmarks for dl24.py, no hardware needed
+# usage: ./bench_dl24.py [framer] [latency] [state] [loss] [idle] [soak] [startup] [--time secs] [--json file] [--compare old.json]
+
+from time import perf_counter,sleep
+from sys import argv,exit
+import sys,os
+import random
+
+import dl24
+
+
+
+####################
+##
+##  REFERENCE PARSER
+##
+####################
+
+# the original list-based receive buffer of Instr_Atorch (append per byte, pop(0) on discard, slicing per packet),
+# kept here as the baseline for the framer benchmark
+class LegacyParser:
+  expectshort=False
+  expectans=False
+
+  def __init__(self):
+    self.buf=[]
+    self.packet=[]
+    self.packetlong=[]
+    self.frames=0
+
+  def feed(self,r):
+    for x in r: self.buf.append(x)
+
+  def flushbuf(self,discard=False):
+    if discard: self.buf.pop(0)
+    while len(self.buf)>0:
+      if (self.expectshort and self.buf[0]==0x6F) or (self.expectans and self.buf[0]==0xCA) or (self.buf[0]==0xff): return True
+      self.buf.pop(0)
+    return False
+
+  def check_crc(self,data):
+    return ((sum(data[2:-1])^0x44)&0xff)==data[-1]
+
+  def recvpacket(self):
+    if not self.flushbuf(): return False
+    if self.buf[0]==0x6F:
+      self.packet=[self.buf.pop(0)]
+      self.expectshort=False
+      return True
+    while len(self.buf)>0:
+      if self.buf[0]==0xCA:
+        if len(self.buf)<7: return False
+        if self.buf[1]!=0xCB or self.buf[5]!=0xCE or self.buf[6]!=0xCF:
+          self.flushbuf(discard=True);continue
+        self.packet=self.buf[:7].copy()
+        self.buf=self.buf[7:]
+        return True
+      if self.buf[0]==0xFF:
+        if len(self.buf)<3: return False
+        if self.buf[1]==0x55:
+          if self.buf[2]==0x01:
+            if len(self.buf)<36: return False
+            self.packetlong=self.buf[:36].copy()
+            self.buf=self.buf[36:]
+            if self.check_crc(self.packetlong): return True
+            self.packetlong=[]
+            return False
+          if self.buf[2]==0x02:
+            if len(self.buf)<8: return False
+            self.packet=self.buf[:8].copy()
+            self.buf=self.buf[8:]
+            if self.check_crc(self.packet): return True
+            self.packet=[]
+            return False
+      self.flushbuf(discard=True)
+    return False
+
+  # drain everything parseable, the way repeated recvdata() calls would
+  def drain(self):
+    while len(self.buf)>0:
+      n=len(self.buf)
+      if self.recvpacket(): self.frames+=1
+      elif len(self.buf)==n: break
+
+
+
+####################
+##
+##  TEST DATA
+##
+####################
+
+def statusframe(adu=2,v=123,a=4567,temp=23):
+  p=bytes([0xff,0x55,0x01,adu])+v.to_bytes(3,'big')+a.to_bytes(3,'big')+bytes(14)+temp.to_bytes(2,'big')+bytes([0,0,10,51,60,0,0,0,0])
+  return p+bytes([((sum(p[2:])^0x44)&0xff)])
+
+def px100reply(val):
+  return bytes([0xca,0xcb])+val.to_bytes(3,'big')+bytes([0xce,0xcf])
+
+# stream of status frames and PX100 replies, with noise bursts of given length between them
+def makestream(nframes,noise=0,seed=1):
+  rnd=random.Random(seed)
+  out=bytearray()
+  for n in range(nframes):
+    if n%4==0: out+=statusframe(v=rnd.randrange(0,2000),a=rnd.randrange(0,24000))
+    else: out+=px100reply(rnd.randrange(0,1<<24))
+    if noise: out+=bytes(rnd.choice(b'\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99') for x in range(noise))
+  return bytes(out)
+
+def chunks(data,size):
+  return [data[x:x+size] for x in range(0,len(data),size)]
+
+
+
+####################
+##
+##  BENCHMARKS
+##
+####################
+
+def run_framer(parts):
+  f=dl24.AtorchFramer()
+  f.expectans=True
+  t=perf_counter()
+  for x in parts:
+    f.feed(x)
+    while f.next()!=None: pass
+  return perf_counter()-t,f.frames
+
+def run_legacy(parts):
+  p=LegacyParser()
+  p.expectans=True
+  t=perf_counter()
+  for x in parts:
+    p.feed(x)
+    p.drain()
+  return perf_counter()-t,p.frames
+
+def bench_framer(results):
+  print('FRAMER: parser throughput, framer vs. original list buffer')
+  for noise,chunk in [(0,64),(0,4096),(16,256),(200,4096),(2000,16384)]:
+    data=makestream(2000,noise=noise)
+    parts=chunks(data,chunk)
+    r={'noise':noise,'chunk':chunk,'bytes':len(data)}
+    for name,fn in [('framer',run_framer),('legacy',run_legacy)]:
+      dt,frames=fn(parts)
+      r[name]={'s':dt,'frames':frames,'MBps':len(data)/dt/1e6,'fps':frames/dt}
+    print(f"  noise={noise:5} chunk={chunk:5}  framer {r['framer']['MBps']:8.2f} MB/s {r['framer']['fps']:10.0f} frames/s"
+          f"   legacy {r['legacy']['MBps']:8.2f} MB/s {r['legacy']['fps']:10.0f} frames/s   x{r['legacy']['s']/r['framer']['s']:.1f}")
+    results.setdefault('framer',[]).append(r)
+
+
+# simulated device (dl24.LowLevelSimPort) served on a loopback TCP socket or a pty, so the real transports are exercised
+class SimServer:
+  def __init__(self,opts='lat=0.005',kind='tcp',statusperiod=1):
+    import socket,threading,os,tty
+    self.sim=dl24.LowLevelSimPort(opts)
+    self.sim.statusperiod=statusperiod
+    self.requests=0
+    self.kind=kind
+    if kind=='pty':
+      self.fd,slave=os.openpty()
+      tty.setraw(slave)
+      self.path=os.ttyname(slave)
+      self.slave=slave
+    else:
+      self.lsock=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+      self.lsock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+      self.lsock.bind(('127.0.0.1',0))
+      self.lsock.listen(1)
+      self.port=self.lsock.getsockname()[1]
+    threading.Thread(target=self.serve,daemon=True).start()
+
+  def client(self):
+    if self.kind=='pty': return dl24.LowLevelSerPort(self.path,dl24.DEFAULT_BAUDRATE)
+    return dl24.LowLevelTcpPort('127.0.0.1',self.port)
+
+  # one connection after another for TCP, the device state persists
+  def serve(self):
+    import socket
+    self.sim.connect()
+    if self.kind=='pty': self.session(self.fd);return
+    while True:
+      c,a=self.lsock.accept()
+      c.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+      self.conn=c
+      self.sim.recvflush()
+      self.session(c.fileno())
+      c.close()
+
+  def session(self,fd):
+    import os,select
+    from time import monotonic
+    try:
+      while True:
+        t=self.sim.nextevent()
+        r,w,x=select.select([fd],[],[],0.05 if t==None else min(0.05,max(0,t-monotonic())))
+        if r:
+          d=os.read(fd,4096)
+          if not d: return
+          self.requests+=d.count(b'\xb1\xb2')
+          self.sim.send(d)
+        n=self.sim.avail()
+        if n: os.write(fd,self.sim.recv(n))
+    except OSError: return
+
+def percentiles(a):
+  a=sorted(a)
+  return {'p50':a[len(a)//2],'p90':a[int(len(a)*0.9)],'p99':a[min(len(a)-1,int(len(a)*0.99))],'max':a[-1],'mean':sum(a)/len(a)}
+
+# Instr_Atorch on the given transport; messages to stdlog are collected in instr.log
+def mkinstr(comm):
+  import io
+  instr=dl24.Instr_Atorch()
+  instr.initport(comm)
+  instr.connect()
+  instr.log=io.StringIO()
+  return instr
+
+def quiet(instr,fn,*args):
+  import io,contextlib
+  old=dl24.stdlog;dl24.stdlog=instr.log
+  try:
+    with contextlib.redirect_stdout(io.StringIO()): return fn(*args)
+  finally: dl24.stdlog=old
+
+def timeit(n,fn,*args):
+  lat=[]
+  for x in range(n):
+    t=perf_counter();fn(*args);lat.append(perf_counter()-t)
+  return lat
+
+def transports(lat):
+  yield 'sim',None,dl24.LowLevelSimPort(f'lat={lat}')
+  for k in ['tcp','pty']:
+    srv=SimServer(f'lat={lat}',kind=k)
+    yield k,srv,srv.client()
+
+def bench_latency(results,n=50,lat=0.005):
+  print(f'LATENCY: PX100 query round trip and verified setamp rate, device answering after {lat*1000:.0f} ms')
+  res={}
+  for name,srv,comm in transports(lat):
+    instr=mkinstr(comm)
+    r={'query':percentiles(quiet(instr,timeit,n,instr.cmd_getvolt))}
+    k=0;cnt=0;t=perf_counter()
+    while perf_counter()-t<2:
+      k=1-k;quiet(instr,instr.setamp,1.0+k*0.5,False);cnt+=1
+    r['setamp_per_s']=cnt/(perf_counter()-t)
+    instr.comm.close()
+    res[name]=r
+    print(f"  {name:5} query "+'  '.join(f'{x} {v*1000:7.2f} ms' for x,v in r['query'].items())+f"   setamp {r['setamp_per_s']:6.1f}/s")
+
+  import asyncio
+  async def arun():
+    srv=SimServer(f'lat={lat}')
+    a=await dl24.AsyncAtorch().open_tcp('127.0.0.1',srv.port)
+    res=[]
+    for x in range(n):
+      t=perf_counter();await a.getvolt();res.append(perf_counter()-t)
+    a.close()
+    return res
+  res['async']={'query':percentiles(asyncio.run(arun()))}
+  print(f"  async query "+'  '.join(f'{x} {v*1000:7.2f} ms' for x,v in res['async']['query'].items()))
+  results['latency']=res
+
+
+def bench_state(results,n=10,lat=0.005):
+  print('STATE: latency per option set, tcp transport')
+  res={}
+  srv=SimServer(f'lat={lat}')
+  instr=mkinstr(srv.client())
+  for opts in ['S','','M','A','AM','L']:
+    quiet(instr,instr.printstate,opts)
+    q=srv.requests
+    res[opts or '-']=r=percentiles(quiet(instr,timeit,n,instr.printstate,opts))
+    r['queries']=(srv.requests-q)/n
+    print(f"  {opts or '-':3} "+'  '.join(f'{x} {v*1000:7.2f} ms' for x,v in r.items() if x!='queries')+f"   {r['queries']:.1f} queries")
+  instr.comm.close()
+  results['state']=res
+
+
+def bench_loss(results,n=10,lat=0.005):
+  print('LOSS: retry overhead under injected request/reply loss, tcp transport')
+  res=[]
+  for loss in [0,0.02,0.1,0.2]:
+    srv=SimServer(f'lat={lat},loss={loss},seed=1')
+    instr=mkinstr(srv.client())
+    r={'loss':loss}
+    q=srv.requests
+    r['state']=percentiles(quiet(instr,timeit,n,instr.printstate,'A'))
+    r['state_requests']=(srv.requests-q)/n
+    q=srv.requests;k=0;a=[]
+    for x in range(n):
+      k=1-k;t=perf_counter();quiet(instr,instr.setamp,1.0+k*0.5,False);a.append(perf_counter()-t)
+    r['setamp']=percentiles(a)
+    r['setamp_requests']=(srv.requests-q)/n
+    r['timeouts']=instr.log.getvalue().count('TIMEOUT')
+    r['srtt']=instr.rtt.srtt;r['rto']=instr.rtt.rto
+    instr.comm.close()
+    res.append(r)
+    print(f"  loss={loss:4.2f}  STATE:A mean {r['state']['mean']*1000:7.1f} ms p90 {r['state']['p90']*1000:7.1f} ms {r['state_requests']:5.1f} req"
+          f"   setamp mean {r['setamp']['mean']*1000:7.1f} ms {r['setamp_requests']:4.1f} req   {r['timeouts']} timeouts   rto {r['rto']*1000:.0f} ms")
+  results['loss']=res
+
+
+# run dl24.py as a separate process against a simulated device, sampling /proc for CPU, context switches and memory
+def procstat(pid):
+  with open(f'/proc/{pid}/stat') as f: st=f.read().rsplit(')',1)[1].split()
+  r={'cpu':(int(st[11])+int(st[12]))/os.sysconf('SC_CLK_TCK')}
+  with open(f'/proc/{pid}/status') as f:
+    for l in f:
+      k,v=l.split(':',1)
+      if k in ['voluntary_ctxt_switches','nonvoluntary_ctxt_switches']: r['wakeups']=r.get('wakeups',0)+int(v)
+      if k=='VmRSS': r['rss_kB']=int(v.split()[0])
+  return r
+
+def runproc(srv,cmds,secs):
+  import subprocess,tempfile
+  with tempfile.TemporaryDirectory() as home:
+    p=subprocess.Popen([sys.executable,dl24.__file__,f'TCP=127.0.0.1:{srv.port}']+cmds,stdin=subprocess.PIPE,
+                       stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL,env=dict(os.environ,HOME=home))
+    sleep(1)
+    a=procstat(p.pid)
+    sleep(secs)
+    b=procstat(p.pid)
+    p.kill();p.wait()
+  return {'secs':secs,'cpu_pct':(b['cpu']-a['cpu'])/secs*100,'wakeups_per_s':(b['wakeups']-a['wakeups'])/secs,
+          'rss_start_kB':a['rss_kB'],'rss_end_kB':b['rss_kB']}
+
+def bench_idle(results):
+  print(f'IDLE: CPU and wakeups of the waiting loops over {RUNTIME} s, 1 status packet/s')
+  res={}
+  for name,cmds in [('listen',['LISTEN']),('stdin',['STDIN'])]:
+    res[name]=r=runproc(SimServer(),cmds,RUNTIME)
+    print(f"  {name:6} cpu {r['cpu_pct']:5.2f} %  {r['wakeups_per_s']:7.1f} wakeups/s  rss {r['rss_end_kB']} kB")
+  results['idle']=res
+
+def bench_soak(results,rate=200):
+  print(f'SOAK: LISTEN at {rate} status packets/s over {RUNTIME} s')
+  r=runproc(SimServer(statusperiod=1/rate),['LISTEN'],RUNTIME)
+  r['rate']=rate
+  print(f"  cpu {r['cpu_pct']:5.2f} %  rss {r['rss_start_kB']} -> {r['rss_end_kB']} kB")
+  results['soak']=r
+
+
+# one-shot invocations: wall time of the whole process, and time to the first send as reported by PROFILE
+def bench_startup(results,n=10):
+  import subprocess,tempfile,re
+  print(f'STARTUP: one-shot QV over tcp, best of {n}, budget to first send {dl24.STARTUP_BUDGET*1000:.0f} ms')
+  srv=SimServer('lat=0')
+  here=os.path.dirname(os.path.abspath(dl24.__file__))
+  res={}
+  with tempfile.TemporaryDirectory() as home:
+    env=dict(os.environ,HOME=home)
+    env.pop('PYTHONDONTWRITEBYTECODE',None) # the launcher relies on the bytecode cache
+    for name,exe in [('dl24.py','dl24.py'),('launcher','dl24')]:
+      wall=[];first=[]
+      for x in range(n):
+        t=perf_counter()
+        p=subprocess.run([sys.executable,os.path.join(here,exe),f'TCP=127.0.0.1:{srv.port}','QV','PROFILE'],capture_output=True,text=True,env=env)
+        wall.append(perf_counter()-t)
+        m=re.search(r'first send after ([0-9.]+) ms',p.stderr)
+        if m: first.append(float(m.group(1))/1000)
+      res[name]=r={'wall':min(wall),'first_send':min(first) if first else None}
+      r['within_budget']=r['first_send']!=None and r['first_send']<=dl24.STARTUP_BUDGET
+      print(f"  {name:9} process {r['wall']*1000:7.2f} ms   first send {r['first_send']*1000 if first else -1:6.2f} ms after load"+('' if r['within_budget'] else '  OVER BUDGET'))
+  results['startup']=res
+
+
+# numeric leaves of a result tree, by path
+def flatten(d,path=''):
+  if isinstance(d,dict):
+    for k,v in d.items(): yield from flatten(v,f'{path}/{k}' if path else str(k))
+  elif isinstance(d,list):
+    for n,v in enumerate(d): yield from flatten(v,f'{path}[{n}]')
+  elif isinstance(d,(int,float)) and not isinstance(d,bool): yield path,d
+
+def compare(old,new):
+  print('COMPARE: old -> new')
+  o=dict(flatten(old))
+  for k,v in flatten(new):
+    if k not in o: continue
+    ratio=f'x{v/o[k]:.2f}' if o[k] else ''
+    print(f'  {k:50} {o[k]:12.4g} -> {v:12.4g}  {ratio}')
+
+
+
+RUNTIME=5 # seconds, for the process benchmarks
+BENCHES={'framer':bench_framer,'latency':bench_latency,'state':bench_state,'loss':bench_loss,'idle':bench_idle,'soak':bench_soak,'startup':bench_startup}
+
+if __name__=="__main__":
+  args=argv[1:]
+  opts={}
+  for o in ['--json','--compare','--time']:
+    if o in args:
+      n=args.index(o)
+      if n+1>=len(args): print(o,'needs an argument');exit(1)
+      opts[o]=args[n+1]
+      del args[n:n+2]
+  if '--time' in opts: RUNTIME=float(opts['--time'])
+  if args==[]: args=list(BENCHES)
+  results={}
+  for x in args:
+    if x not in BENCHES: print('unknown benchmark:',x,'; available:',' '.join(BENCHES));exit(1)
+    BENCHES[x](results)
+  if '--json' in opts:
+    from json import dump
+    with open(opts['--json'],'w') as f: dump(results,f,indent=1)
+  if '--compare' in opts:
+    from json import load
+    with open(opts['--compare']) as f: compare(load(f),results)
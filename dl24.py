@@ -2,11 +2,16 @@
 
 import socket
 import errno
-from struct import pack
+from struct import pack,Struct
 from time import sleep,monotonic
-from sys import argv,exit,stdin,stderr
+from sys import argv,exit,stdin,stdout,stderr
 from select import select
+from bisect import bisect_left
 # other imports are placed where they are needed, to avoid crashing whole software instead of a single function on a missing dependency
+# and to keep the startup short; see PROFILE
+
+T_LOAD=monotonic()   # reference for startup profiling
+STARTUP_BUDGET=0.02  # seconds from module load to the first byte sent, for a one-shot query
 
 
 #DEFAULT_SERPORT='/dev/ttyUSB0'
@@ -27,6 +32,125 @@ stdlog=stderr
 
 
 
+####################
+##
+##  METRICS
+##
+####################
+
+DEFAULT_METRICSPORT=9124
+
+# counters and histograms, cheap enough to stay on; label is a preformatted string, eg. 'cmd="11"'
+# collectors are called at render time, for counters that already exist elsewhere (framer)
+# updates come from the main thread, renders from the HTTP/dump threads: both under the lock, rendering from copies
+class Metrics:
+  RTTBUCKETS=[0.002,0.005,0.01,0.02,0.05,0.1,0.2,0.5,1,2,5]
+  JITTERBUCKETS=[0.001,0.002,0.005,0.01,0.02,0.05,0.1,0.2,0.5,1]
+
+  def __init__(self):
+    from threading import Lock
+    self.counters={}
+    self.hists={}
+    self.collectors=[]
+    self.server=None
+    self.lock=Lock()
+
+  def inc(self,name,n=1,label=None):
+    k=(name,label)
+    with self.lock: self.counters[k]=self.counters.get(k,0)+n
+
+  def observe(self,name,val,label=None,buckets=RTTBUCKETS):
+    with self.lock:
+      h=self.hists.get((name,label))
+      if h==None: h=self.hists[(name,label)]=[buckets,[0]*(len(buckets)+1),0.0,0] # buckets, counts, sum, count
+      h[1][bisect_left(buckets,val)]+=1
+      h[2]+=val
+      h[3]+=1
+
+  def collect(self,fn):
+    with self.lock: self.collectors.append(fn)
+
+  # consistent copies: (counters with collected values, histograms)
+  def snapshot(self):
+    with self.lock:
+      r=dict(self.counters)
+      hists={k:(b,list(cnt),sm,n) for k,(b,cnt,sm,n) in self.hists.items()}
+      collectors=list(self.collectors)
+    for fn in collectors:
+      for name,label,val in fn(): r[(name,label)]=r.get((name,label),0)+val
+    return r,hists
+
+  def values(self):
+    return self.snapshot()[0]
+
+  def render(self):
+    def lbl(label,extra=None):
+      l=[x for x in [label,extra] if x]
+      return '{'+','.join(l)+'}' if l else ''
+    out=[];types=set()
+    values,hists=self.snapshot()
+    for (name,label),val in sorted(values.items(),key=lambda x:(x[0][0],x[0][1] or '')):
+      if name not in types: out.append(f'# TYPE {name} counter');types.add(name)
+      out.append(f'{name}{lbl(label)} {val}')
+    for (name,label),(b,cnt,sm,n) in sorted(hists.items(),key=lambda x:(x[0][0],x[0][1] or '')):
+      if name not in types: out.append(f'# TYPE {name} histogram');types.add(name)
+      c=0
+      for le,x in zip(b+['+Inf'],cnt):
+        c+=x
+        le='le="%s"'%le
+        out.append(f'{name}_bucket{lbl(label,le)} {c}')
+      out.append(f'{name}_sum{lbl(label)} {sm}')
+      out.append(f'{name}_count{lbl(label)} {n}')
+    return '\n'.join(out)+'\n'
+
+  def dump(self):
+    r={}
+    values,hists=self.snapshot()
+    for (name,label),val in values.items(): r[name+('{'+label+'}' if label else '')]=val
+    for (name,label),(b,cnt,sm,n) in hists.items():
+      r[name+('{'+label+'}' if label else '')]={'count':n,'sum':sm,'buckets':dict(zip([str(x) for x in b]+['+Inf'],cnt))}
+    return r
+
+  # /metrics in Prometheus text format, /metrics.json as JSON, from a background thread
+  def serve(self,port=DEFAULT_METRICSPORT,addr='127.0.0.1'):
+    if self.server!=None: return
+    from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+    from threading import Thread
+    from json import dumps
+    m=self
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path=='/metrics': body=m.render();ctype='text/plain; version=0.0.4'
+        elif self.path=='/metrics.json': body=dumps(m.dump());ctype='application/json'
+        else: self.send_error(404);return
+        body=body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type',ctype)
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+      def log_message(self,*args): pass
+    self.server=ThreadingHTTPServer((addr,port),Handler)
+    self.server.daemon_threads=True
+    Thread(target=self.server.serve_forever,daemon=True).start()
+
+  # periodic JSON dump, written to a temporary file and renamed over
+  def dumpevery(self,fn,secs=10):
+    from threading import Thread
+    from json import dump
+    from time import time
+    import os
+    def run():
+      while True:
+        sleep(secs)
+        with open(fn+'.tmp','w') as f: dump({'time':time(),'metrics':self.dump()},f)
+        os.replace(fn+'.tmp',fn)
+    Thread(target=run,daemon=True).start()
+
+metrics=Metrics()
+
+
+
 ####################
 ##
 ##  LOW LEVEL SERIAL
@@ -35,7 +159,6 @@ stdlog=stderr
 
 
 class LowLevelSerPort:
-  import serial
   serport='/dev/ttyUSB0'            # target serial port
   baudrate=0
   port=None                         # physical port instance
@@ -55,11 +178,15 @@ class LowLevelSerPort:
 
   def connect(self):
     if self.verbconn: print('SERPORT:connecting to',self.serport,'@',self.baudrate,file=stdlog)
+    try: import serial
+    except ImportError as e:
+      print('ERRPORTCONN: pyserial needed for serial ports:',e,file=stdlog)
+      exit(12)
     for t in range(0,self.connretries):
       try:
         if t>0: print('retrying...',t)
-        #self.port=self.serial.Serial(self.serport,self.baudrate, timeout=self.timeout)
-        self.port=self.serial.serial_for_url(self.serport,self.baudrate, timeout=self.timeout)
+        #self.port=serial.Serial(self.serport,self.baudrate, timeout=self.timeout)
+        self.port=serial.serial_for_url(self.serport,self.baudrate, timeout=self.timeout)
         self.connected=True
         break
       except Exception as e:
@@ -79,11 +206,13 @@ class LowLevelSerPort:
 
   def send(self,raw,showpacket=None):
     if showpacket!=None and self.verbconn: showpacket(raw,name='SERPORT:SEND',check=False)
+    metrics.inc('dl24_bytes_sent_total',len(raw),'transport="serial"')
     self.port.write(raw)
     return False
 
   def recv(self,l,showpacket=None):
     res=self.port.read(l)
+    metrics.inc('dl24_bytes_received_total',len(res),'transport="serial"')
     if showpacket!=None and self.verbconn: showpacket(res,name='SERPORT:RECV',check=False)
     return res
 
@@ -95,6 +224,17 @@ class LowLevelSerPort:
   def avail(self):
     return self.port.in_waiting
 
+  # file descriptor for select(), None if the port has none
+  def fileno(self):
+    try: return self.port.fileno()
+    except Exception: return None
+
+  # wait for incoming data up to timeout; ports without fileno (some URL handlers) just nap briefly
+  def wait(self,timeout):
+    try: r,w,e=select([self.port],[],[],timeout)
+    except (AttributeError,TypeError,ValueError,OSError): sleep(min(timeout,0.005));return True
+    return r!=[]
+
 
 
 ####################
@@ -103,92 +243,680 @@ class LowLevelSerPort:
 ##
 ####################
 
+# TCP transport for serial-over-TCP bridges (Tasmota and alike); nonblocking socket, reads into a preallocated buffer
+# the connection is a state machine driven by avail(), send() and wait(): down -> connecting -> up, and down again on error,
+# end of stream or silence; reconnects go with jittered exponential backoff, forever; commands sent while not connected
+# are dropped, the caller sees no reply and retries or reports the failure, nothing goes out later behind its back
 class LowLevelTcpPort:
   ipaddr=None             # target IP
   ipport=None             # target port
   sock=None
   verbconn=False
   verbport=False
-  timeout=3
-  flushtimeout=0.02
-  connretries=5
-  connected=False
+  timeout=3               # wait for the first connection in connect()
+  state='down'            # down, connecting, up
+  generation=0            # counts sockets, for event loops to register the new one
 
   reconnect=True
-  default_timeout=5 # reconnect timeout for data loss
+  default_timeout=5       # reconnect after this long without data, the device sends status every second
   time_lastread=-1
-
-  buf=None
+  backoffmin=0.5          # reconnect delay, doubled after each failure up to backoffmax, randomized by half
+  backoffmax=30
+  bufsize=4096
+  keepalive=(10,5,3)      # TCP keepalive idle, interval, count
 
   def __init__(self,addr,port):
     self.ipaddr=addr
     self.ipport=port
+    self.rbuf=bytearray(self.bufsize)
+    self.rview=memoryview(self.rbuf)
+    self.rpos=0             # received bytes are rbuf[rpos:rlen]
+    self.rlen=0
+    self.outq=bytearray()   # going out on the current connection
+    self.failures=0
+    self.retryat=0
 
   def connect(self):
+    self.reconnect=True
+    self.startconnect()
+    deadline=monotonic()+self.timeout
+    while self.state!='up' and monotonic()<deadline: self.wait(deadline-monotonic())
+    if self.state!='up': print('SOCK:not connected to',self.ipaddr,':',self.ipport,'- retrying in background',file=stdlog)
+    return self.sock
+
+  def startconnect(self):
+    from os import strerror
     if self.verbconn: print('SOCK:connecting to',self.ipaddr,':',self.ipport,file=stdlog)
-    self.sock=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    self.sock.settimeout(self.timeout)
-    for t in range(0,self.connretries):
-      try:
-        if t>0: print('SOCK:connection retrying...',t,file=stdlog)
-        self.sock.connect( (self.ipaddr,self.ipport) )
-        self.connected=True
-        break
-      except Exception as e:
-        print('SOCKCONNERR:',e)
-        sleep(min(0.5+t,5)) # increase retries delay, max. 5s
-    if not self.connected:
-      print('ERRSOCKCONN: cannot connect to',self.ipaddr,':',self.ipport,'- too many retries. Aborting.',file=stdlog)
-      exit(12)
-    self.sock.setblocking(False) # nonblocking
-    if self.verbconn: print('SOCK:connected',file=stdlog)
+    self.sock=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    self.sock.setblocking(False)
+    self.generation+=1
+    self.state='connecting'
+    self.retryat=monotonic()+self.timeout # connect timeout
+    try: err=self.sock.connect_ex((self.ipaddr,self.ipport))
+    except OSError as e: err=e.errno  # name resolution
+    if err not in (0,errno.EINPROGRESS,errno.EWOULDBLOCK,errno.EAGAIN): self.lost(f'connect: {strerror(err) if isinstance(err,int) else err}')
+
+  def established(self):
+    s=self.sock
+    s.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+    s.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1)
+    for name,v in zip(['TCP_KEEPIDLE','TCP_KEEPINTVL','TCP_KEEPCNT'],self.keepalive):
+      if hasattr(socket,name): s.setsockopt(socket.IPPROTO_TCP,getattr(socket,name),v)
+    self.state='up'
     self.time_lastread=monotonic()
-    return self.sock
+    if self.verbconn: print('SOCK:connected',file=stdlog)
+    self.flushout()
+
+  # connection gone: close, schedule the next attempt
+  def lost(self,why):
+    from random import random
+    if self.sock!=None:
+      try: self.sock.close()
+      except OSError: pass
+    if self.state=='up': metrics.inc('dl24_reconnects_total',1,'transport="tcp"')
+    self.sock=None
+    self.state='down'
+    self.rpos=self.rlen=0
+    self.outq=bytearray() # may start inside a command half sent on the old connection
+    d=min(self.backoffmax,self.backoffmin*2**self.failures)
+    d=d/2+random()*d/2
+    self.failures+=1
+    self.retryat=monotonic()+d
+    print(f'SOCK:{why}; reconnect in {d:.1f} s',file=stderr)
+
+  # advance the connection state machine
+  def progress(self):
+    from os import strerror
+    if self.state=='down':
+      if self.reconnect and monotonic()>=self.retryat: self.startconnect()
+      return
+    if self.state=='connecting':
+      r,w,e=select([],[self.sock],[],0)
+      if w:
+        err=self.sock.getsockopt(socket.SOL_SOCKET,socket.SO_ERROR)
+        if err==0: self.established()
+        else: self.lost(f'connect: {strerror(err)}')
+      elif monotonic()>=self.retryat: self.lost('connect: timeout')
+      return
+    if self.outq: self.flushout()
+
+  def flushout(self):
+    try: n=self.sock.send(self.outq)
+    except (BlockingIOError,InterruptedError): return
+    except OSError as e: self.lost(f'send: {e}');return
+    del self.outq[:n]
 
   def close(self):
     if self.verbconn: print('SOCK:closed',file=stdlog)
-    self.sock.close()
-
+    self.reconnect=False
+    if self.sock!=None: self.sock.close()
+    self.sock=None
+    self.state='down'
 
+  # nonblocking; what the socket does not take now goes out from progress(); dropped while not connected
   def send(self,raw,showpacket=None):
     if showpacket!=None and self.verbport: showpacket(raw,name='SOCK:SEND',check=False,file=stdlog)
-    try:  return self.sock.sendall(raw)
-    except socket.error as e:
-      print('SOCK:SEND:ERR:',e,file=stderr)
-      if self.reconnect: self.connect()
+    if self.state!='up':
+      self.progress()
+      return
+    metrics.inc('dl24_bytes_sent_total',len(raw),'transport="tcp"')
+    self.outq+=raw
+    self.flushout()
 
-# WARN: ignores l
   def recv(self,l,showpacket=None):
-#    res=self.sock.recv(l)
-    res=self.buf
+    l=min(l,self.rlen-self.rpos)
+    res=bytes(self.rview[self.rpos:self.rpos+l])
+    self.rpos+=l
+    if self.rpos==self.rlen: self.rpos=self.rlen=0
     if showpacket!=None and self.verbport: showpacket(res,name='SOCK:RECV',check=False,file=stdlog)
     return res
 
+  # drop what has arrived, without waiting
   def recvflush(self):
-    #print('flush')
-    self.sock.settimeout(self.flushtimeout)
-    try: n=len(self.sock.recv(1024))
-    except socket.timeout: n=0
-    self.sock.settimeout(self.timeout)
+    n=self.avail()
+    self.rpos=self.rlen=0
     return n
 
-  # actual reading happens here, do recv() if result nonzero!
+  # reads what the socket has into the buffer; bytes available for recv()
   def avail(self):
-    #return self.port.in_waiting
-    try: self.buf=self.sock.recv(256)
-    except socket.error as e:
-      err=e.args[0]
-      if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
-        if monotonic()-self.time_lastread>self.default_timeout:
-          print('SOCK:RECV:TIMEOUT',file=stderr)
-          try: self.close()
-          except Exception as e: print('SOCK:CLOSE:ERR:',e,file=stderr)
-          self.connect()
-        return 0
-      print('SOCK:RECV:ERR:',e,file=stderr)
-      if self.reconnect: self.connect()
-    self.time_lastread=monotonic()
-    return len(self.buf)
+    self.progress()
+    if self.state!='up': return self.rlen-self.rpos
+    if self.rpos>0 and self.rlen>self.bufsize//2: # make room at the end, copied out first as the ranges overlap
+      d=bytes(self.rview[self.rpos:self.rlen])
+      self.rbuf[:len(d)]=d
+      self.rpos=0;self.rlen=len(d)
+    n=0
+    while self.rlen<self.bufsize:
+      try: r=self.sock.recv_into(self.rview[self.rlen:])
+      except (BlockingIOError,InterruptedError): break
+      except OSError as e: self.lost(f'recv: {e}');return 0
+      if r==0: self.lost('connection closed by peer');return 0
+      self.rlen+=r;n+=r
+    if n>0:
+      metrics.inc('dl24_bytes_received_total',n,'transport="tcp"')
+      self.time_lastread=monotonic()
+      self.failures=0 # backoff reset only by a link that carries data, a bridge may accept and drop
+    elif monotonic()-self.time_lastread>self.default_timeout: self.lost('no data');return 0
+    return self.rlen-self.rpos
+
+  # socket of the current connection, changes on reconnect; None while down
+  def fileno(self):
+    return None if self.sock==None else self.sock.fileno()
+
+  # when the state machine has something to do without socket events: reconnect, connect timeout, silence, queued sends
+  def nextevent(self):
+    if self.state=='down': return self.retryat if self.reconnect else None
+    if self.state=='connecting': return min(self.retryat,monotonic()+0.05)
+    if self.outq: return monotonic()+0.05
+    return self.time_lastread+self.default_timeout+0.01
+
+  # wait for incoming data up to timeout
+  def wait(self,timeout):
+    self.progress()
+    if self.rlen>self.rpos: return True
+    if self.state=='down':
+      sleep(max(0,min(timeout,self.retryat-monotonic())))
+      self.progress()
+      return False
+    if self.state=='connecting':
+      select([],[self.sock],[],max(0,min(timeout,self.retryat-monotonic())))
+      self.progress()
+      return False
+    r,w,e=select([self.sock],[self.sock] if self.outq else [],[],timeout)
+    if w: self.flushout()
+    return r!=[]
+
+
+
+########################
+##
+##  SIMULATED DEVICE
+##
+########################
+
+# device model answering PX100 and Atorch requests, with a source model behind the load:
+#   bat:vfull:vempty:Ah:ohms - battery, open-circuit voltage falling linearly with the charge taken
+#   psu:volts:ohms           - constant voltage source with internal resistance
+class SimDevice:
+  def __init__(self,adu=2,model='bat:12.6:10.5:7:0.05'):
+    self.adu=adu
+    self.out=0
+    self.iset=0       # 10mA units
+    self.vcut=0       # 10mV units
+    self.timer=0
+    self.mah=0.0
+    self.mwh=0.0
+    self.runtime=0.0
+    self.temp=25.0
+    self.t=None
+    self.rx=b''
+    m=(model+':::::').split(':')
+    self.model=m[0]
+    if m[0]=='psu': self.v0=float(m[1] or 12);self.rint=float(m[2] or 0.05)
+    else:
+      self.model='bat'
+      self.vfull=float(m[1] or 12.6);self.vempty=float(m[2] or 10.5);self.cap=float(m[3] or 7)*1000;self.rint=float(m[4] or 0.05)
+
+  def voc(self):
+    if self.model=='psu': return self.v0
+    soc=max(0.0,1-self.mah/self.cap)
+    return self.vempty+(self.vfull-self.vempty)*soc if soc>0 else 0.0
+
+  def current(self):
+    if not self.out: return 0.0
+    return max(0.0,min(self.iset/100,self.voc()/self.rint))
+
+  def volt(self):
+    return max(0.0,self.voc()-self.current()*self.rint)
+
+  # advance the model to time t
+  def step(self,t):
+    if self.t==None: self.t=t
+    dt=t-self.t;self.t=t
+    if dt<=0: return
+    i=self.current();v=self.volt()
+    self.mah+=i*dt/3.6;self.mwh+=i*v*dt/3.6
+    if self.out: self.runtime+=dt
+    self.temp+=(25+0.8*i*v-self.temp)*min(1,dt/30)
+    if self.out and self.volt()<self.vcut/100: self.out=0 # cutoff, like the real one
+
+  def statuspacket(self):
+    i=self.current();v=self.volt();r=int(self.runtime)
+    val={'V':v,'A':i,'W':v*i,'Ah':self.mah/1000,'Wh':self.mwh/1000,'price':0,'freq':0,'pf':0,
+         'temp':int(self.temp),'hh':r//3600,'mm':r//60%60,'ss':r%60,'bk':60,'Dp':0,'Dm':0}
+    p=bytearray(36);p[0:4]=bytes([0xff,0x55,0x01,self.adu])
+    for k,(o,n,sc) in STATUS_LAYOUTS[self.adu].items():
+      p[o:o+n]=min(int(round(val[k]/sc)),(1<<(8*n))-1).to_bytes(n,'big')
+    p[35]=(sum(p[2:35])^0x44)&0xff
+    return bytes(p)
+
+  def px100(self,cmd,d1,d2):
+    if cmd==0x01: self.out=1 if d1 else 0
+    elif cmd==0x02: self.iset=min(d1*100+d2,int(CURRENT_LIMIT*100))
+    elif cmd==0x03: self.vcut=d1*100+d2
+    elif cmd==0x04: self.timer=d1*256+d2
+    elif cmd==0x05: self.mah=0.0;self.mwh=0.0;self.runtime=0.0
+    if cmd<=0x05: return bytes([PROTO_SHORTACK])
+    r=int(self.runtime)
+    v={0x10:self.out,0x11:int(self.volt()*1000),0x12:int(self.current()*1000),0x13:((r//3600)<<16)+((r//60%60)<<8)+r%60,
+       0x14:int(self.mah),0x15:int(self.mwh),0x16:int(self.temp),0x17:self.iset,0x18:self.vcut,
+       0x19:((self.timer//3600)<<16)+((self.timer//60%60)<<8)+self.timer%60}.get(cmd)
+    if v==None: return b'' # unknown, no answer
+    return bytes([0xca,0xcb])+(v&0xffffff).to_bytes(3,'big')+bytes([0xce,0xcf])
+
+  def atorch(self,cmd):
+    if cmd==0x01 or cmd==0x05: self.mah=0.0;self.mwh=0.0;self.runtime=0.0
+    elif cmd==0x02: self.mah=0.0
+    elif cmd==0x03: self.runtime=0.0
+    elif cmd==0x32: self.out=1-self.out
+    ok=cmd in [0x01,0x02,0x03,0x05,0x21,0x22,0x31,0x32,0x33,0x34]
+    p=bytes([0xff,0x55,0x02,0x01,0x01 if ok else 0x03,0,0])
+    return p+bytes([(sum(p[2:])^0x44)&0xff])
+
+  # feed received bytes, returns list of replies
+  def feed(self,data):
+    self.rx+=data
+    res=[]
+    while True:
+      n=min([x for x in [self.rx.find(b'\xb1\xb2'),self.rx.find(b'\xff\x55\x11')] if x>=0],default=-1)
+      if n<0: self.rx=self.rx[-2:];return res
+      self.rx=self.rx[n:]
+      if self.rx[0]==0xb1:
+        if len(self.rx)<6: return res
+        if self.rx[5]==0xb6: r=self.px100(self.rx[2],self.rx[3],self.rx[4])
+        else: r=b''
+        self.rx=self.rx[6:]
+      else:
+        if len(self.rx)<10: return res
+        r=self.atorch(self.rx[4]) if (sum(self.rx[2:9])^0x44)&0xff==self.rx[9] else b''
+        self.rx=self.rx[10:]
+      if r: res.append(r)
+
+
+# transport to an in-process SimDevice, same interface as the serial and TCP ports
+# opts: comma-separated key=value: adu=2, model=bat:..|psu:.., lat=seconds, baud=9600 (0=no pacing), loss=probability of
+#       a lost request or reply, corrupt=probability per byte, replay=file of recorded bytes streamed instead of status, seed=n
+class LowLevelSimPort:
+  verbconn=False
+  verbport=False
+  connected=False
+  statusperiod=1      # seconds between status packets
+
+  def __init__(self,opts=''):
+    import random
+    o={}
+    for x in opts.split(','):
+      if x.strip()=='': continue
+      a=(x+'=').split('=')
+      o[a[0].strip().lower()]=a[1].strip()
+    self.latency=float(o.get('lat',0.01))
+    self.baud=float(o.get('baud',DEFAULT_BAUDRATE))
+    self.loss=float(o.get('loss',0))
+    self.corrupt=float(o.get('corrupt',0))
+    self.rnd=random.Random(int(o['seed']) if 'seed' in o else None)
+    self.dev=SimDevice(adu=int(o.get('adu',2)),model=o.get('model','bat'))
+    self.replay=None
+    if 'replay' in o:
+      with open(o['replay'],'rb') as f: self.replay=f.read()
+      self.replaypos=0
+    self.opts=o
+    self.pending=[]     # [time available, byte] in order
+    self.linefree=0     # when the simulated line finishes the last scheduled byte
+    self.rxbuf=bytearray()
+    self.nextstatus=None
+
+  def connect(self):
+    if self.verbconn: print('SIM:connecting',self.opts,file=stdlog)
+    self.connected=True
+    self.nextstatus=monotonic()+self.rnd.random()
+    self.dev.step(monotonic())
+    return None
+
+  def close(self):
+    if self.verbconn: print('SIM:closed',file=stdlog)
+    self.connected=False
+
+  # put bytes on the simulated line towards the host
+  def emit(self,data,t):
+    if self.rnd.random()<self.loss: return
+    bt=10/self.baud if self.baud>0 else 0
+    start=max(t+self.latency,self.linefree)
+    for n,b in enumerate(data):
+      if self.corrupt>0 and self.rnd.random()<self.corrupt: b^=1<<self.rnd.randrange(8)
+      self.pending.append((start+(n+1)*bt,b))
+    self.linefree=start+len(data)*bt
+
+  def advance(self):
+    now=monotonic()
+    while self.nextstatus!=None and self.nextstatus<=now:
+      self.dev.step(self.nextstatus)
+      if self.replay!=None:
+        n=int(self.baud/10) if self.baud>0 else 4096 # one second of recorded bytes
+        d=self.replay[self.replaypos:self.replaypos+n]
+        self.replaypos=(self.replaypos+n)%max(1,len(self.replay))
+        self.emit(d,self.nextstatus-self.latency)
+      else: self.emit(self.dev.statuspacket(),self.nextstatus-self.latency)
+      self.nextstatus+=self.statusperiod
+    self.dev.step(now)
+    n=0
+    while n<len(self.pending) and self.pending[n][0]<=now: n+=1
+    if n>0:
+      self.rxbuf+=bytes(x[1] for x in self.pending[:n])
+      del self.pending[:n]
+
+  def send(self,raw,showpacket=None):
+    if showpacket!=None and self.verbport: showpacket(raw,name='SIM:SEND',check=False)
+    metrics.inc('dl24_bytes_sent_total',len(raw),'transport="sim"')
+    self.advance()
+    now=monotonic()
+    bt=10/self.baud if self.baud>0 else 0
+    if self.rnd.random()<self.loss: return False # request lost on the way
+    for r in self.dev.feed(bytes(raw)): self.emit(r,now+len(raw)*bt)
+    return False
+
+  def recv(self,l,showpacket=None):
+    res=bytes(self.rxbuf[:l])
+    del self.rxbuf[:l]
+    metrics.inc('dl24_bytes_received_total',len(res),'transport="sim"')
+    if showpacket!=None and self.verbport: showpacket(res,name='SIM:RECV',check=False)
+    return res
+
+  def recvflush(self):
+    self.advance()
+    n=len(self.rxbuf)
+    self.rxbuf=bytearray()
+    return n
+
+  def avail(self):
+    self.advance()
+    return len(self.rxbuf)
+
+  def fileno(self):
+    return None
+
+  # time of the next byte arriving
+  def nextevent(self):
+    t=[x for x in [self.nextstatus,self.pending[0][0] if self.pending else None] if x!=None]
+    return min(t) if t else None
+
+  def wait(self,timeout):
+    self.advance()
+    if self.rxbuf: return True
+    t=self.nextevent()
+    d=timeout if t==None else min(timeout,max(0,t-monotonic()))
+    sleep(d)
+    self.advance()
+    return len(self.rxbuf)>0
+
+
+
+########################
+##
+##  TRANSPORTS
+##
+########################
+
+# transport registry: name, config key selecting it, factory(conf,cfgint) returning the low level port, minimize queries by default
+# the ports import their backend modules on connect, so the transports not selected cost nothing at startup
+def mkserport(conf,cfgint):
+  baud=DEFAULT_BAUDRATE if 'baudrate' not in conf else cfgint(conf['baudrate'],default=DEFAULT_BAUDRATE)
+  return LowLevelSerPort(conf['serport'],baud)
+
+def mksimport(conf,cfgint):
+  return LowLevelSimPort(conf['sim'])
+
+def mktcpport(conf,cfgint):
+  port=DEFAULT_TCPPORT if 'port' not in conf else cfgint(conf['port'],default=DEFAULT_TCPPORT)
+  return LowLevelTcpPort(conf['host'],port)
+
+TRANSPORTS=[
+  ('serial','serport',mkserport,False),
+  ('sim','sim',mksimport,False),
+  ('tcp','host',mktcpport,True),
+]
+
+
+# PROFILE: timeline of the startup and time spent in imports done after module load, reported at exit
+class StartupProfile:
+  def __init__(self):
+    self.marks=[('load',T_LOAD)]
+    self.imports=[]
+
+  def mark(self,name):
+    self.marks.append((name,monotonic()))
+
+  # time the imports, inclusive of nested ones
+  def hookimports(self):
+    import builtins,sys
+    orig=builtins.__import__
+    def timedimport(name,*args,**kwargs):
+      if name in sys.modules: return orig(name,*args,**kwargs)
+      t=monotonic()
+      try: return orig(name,*args,**kwargs)
+      finally: self.imports.append((name,monotonic()-t))
+    builtins.__import__=timedimport
+
+  # mark the first send on the port, then unwrap
+  def hooksend(self,comm):
+    send=comm.send
+    def firstsend(*args,**kwargs):
+      self.mark('first send')
+      comm.send=send
+      return send(*args,**kwargs)
+    comm.send=firstsend
+
+  def report(self):
+    self.mark('exit')
+    print('PROFILE: startup timeline, ms since module load',file=stdlog)
+    for name,t in self.marks: print(f'  {(t-T_LOAD)*1000:8.2f}  {name}',file=stdlog)
+    for name,t in self.marks:
+      if name!='first send': continue
+      dt=t-T_LOAD
+      print(f'PROFILE: first send after {dt*1000:.2f} ms, budget {STARTUP_BUDGET*1000:.0f} ms'+(' - OVER BUDGET' if dt>STARTUP_BUDGET else ''),file=stdlog)
+    if self.imports:
+      print('PROFILE: imports after load, ms inclusive',file=stdlog)
+      for name,t in sorted(self.imports,key=lambda x:-x[1]): print(f'  {t*1000:8.2f}  {name}',file=stdlog)
+    print('PROFILE: interpreter startup and compiling not included; use the dl24 launcher for cached bytecode, python3 -X importtime for the rest',file=stdlog)
+
+
+
+########################
+##
+##  ROLLUPS
+##
+########################
+
+# one resolution: ring of n buckets of step seconds, min/max/sum per field and energy per bucket, in flat arrays
+class RollupLevel:
+  def __init__(self,step,n,fields):
+    from array import array
+    self.step=step
+    self.n=n
+    self.nf=len(fields)
+    self.bucket=array('q',[-1])*n        # bucket number (wall time // step) held in the slot
+    self.cnt=array('L',[0])*n
+    self.mn=array('d',[0.0])*(n*self.nf)
+    self.mx=array('d',[0.0])*(n*self.nf)
+    self.sm=array('d',[0.0])*(n*self.nf)
+    self.wh=array('d',[0.0])*n
+
+  def add(self,t,vals,wh):
+    b=int(t//self.step)
+    i=b%self.n
+    o=i*self.nf
+    if self.bucket[i]!=b:
+      self.bucket[i]=b;self.cnt[i]=0;self.wh[i]=0.0
+      for k,v in enumerate(vals): self.mn[o+k]=v;self.mx[o+k]=v;self.sm[o+k]=0.0
+    self.cnt[i]+=1
+    self.wh[i]+=wh
+    for k,v in enumerate(vals):
+      if v<self.mn[o+k]: self.mn[o+k]=v
+      if v>self.mx[o+k]: self.mx[o+k]=v
+      self.sm[o+k]+=v
+
+  # buckets from t0 to t1, oldest first: (start time, count, [(min,mean,max) per field], Wh)
+  def query(self,t0,t1):
+    res=[]
+    for b in range(max(int(t0//self.step),int(t1//self.step)-self.n+1),int(t1//self.step)+1):
+      i=b%self.n
+      if self.bucket[i]!=b or self.cnt[i]==0: continue
+      o=i*self.nf;c=self.cnt[i]
+      res.append((b*self.step,c,[(self.mn[o+k],self.sm[o+k]/c,self.mx[o+k]) for k in range(self.nf)],self.wh[i]))
+    return res
+
+# fixed-memory history of the status reports at several resolutions, fed from handlelongpacket()
+class Rollup:
+  FIELDS=['V','A','W','temp']
+  LEVELS={'1s':(1,3600),'10s':(10,8640),'1m':(60,10080),'15m':(900,8640)} # 1 hour, 1 day, 1 week, 90 days
+  SPANUNITS={'s':1,'m':60,'h':3600,'d':86400}
+
+  def __init__(self):
+    self.levels={k:RollupLevel(step,n,self.FIELDS) for k,(step,n) in self.LEVELS.items()}
+    self.last=None  # (time,W) for the energy
+
+  def add(self,t,v,a,temp):
+    w=v*a
+    wh=0.0
+    if self.last!=None and 0<t-self.last[0]<10: wh=(self.last[1]+w)/2*(t-self.last[0])/3600
+    self.last=(t,w)
+    vals=(v,a,w,temp)
+    for l in self.levels.values(): l.add(t,vals,wh)
+
+  @classmethod
+  def parsespan(cls,s):
+    s=s.strip().lower()
+    if s[-1:] in cls.SPANUNITS: return float(s[:-1])*cls.SPANUNITS[s[-1]]
+    return float(s)
+
+  # rows as dicts for the last span seconds at resolution res
+  def history(self,res,span):
+    from time import time
+    now=time()
+    rows=[]
+    for t,c,f,wh in self.levels[res].query(now-span,now):
+      r={'t':t,'n':c}
+      for name,(mn,mean,mx) in zip(self.FIELDS,f): r[name]=[round(mn,4),round(mean,4),round(mx,4)]
+      r['Wh']=round(wh,5)
+      rows.append(r)
+    return rows
+
+
+
+########################
+##
+##  SQLITE STORE
+##
+########################
+
+# runs and their status samples in an SQLite database (WAL mode), shared by several loads
+# add() only queues the raw packet; a writer thread decodes and inserts them in batched transactions, so the receive loop never waits on the disk
+class SampleStore:
+  BATCH=1000        # max. samples per transaction
+  FLUSHSECS=1.0     # max. seconds a sample waits in the queue
+  SCHEMA=['CREATE TABLE IF NOT EXISTS runs(id INTEGER PRIMARY KEY,started REAL,ended REAL,device TEXT,name TEXT)',
+          'CREATE TABLE IF NOT EXISTS meta(run_id INTEGER NOT NULL,key TEXT NOT NULL,value,PRIMARY KEY(run_id,key))',
+          'CREATE TABLE IF NOT EXISTS samples(run_id INTEGER NOT NULL,t REAL NOT NULL,V REAL,A REAL,Ah REAL,Wh REAL,temp REAL,runtime INTEGER)',
+          'CREATE INDEX IF NOT EXISTS samples_run_t ON samples(run_id,t)',
+          'CREATE INDEX IF NOT EXISTS meta_key ON meta(key,value)']
+  INSERT='INSERT INTO samples(run_id,t,V,A,Ah,Wh,temp,runtime) VALUES (?,?,?,?,?,?,?,?)'
+
+  def __init__(self,fn):
+    import sqlite3,threading,queue
+    self.fn=fn
+    self.db=sqlite3.connect(fn,check_same_thread=False,isolation_level=None)
+    self.db.execute('PRAGMA journal_mode=WAL')
+    self.db.execute('PRAGMA synchronous=NORMAL') # in WAL mode still consistent after a crash, the last transactions may be lost
+    self.db.execute('PRAGMA busy_timeout=5000')
+    for x in self.SCHEMA: self.db.execute(x)
+    self.lock=threading.Lock()  # the connection is shared with the writer thread
+    # queries get their own connection: in WAL mode it reads committed data without waiting for the writer
+    self.rdb=sqlite3.connect(fn,check_same_thread=False,isolation_level=None)
+    self.rdb.execute('PRAGMA busy_timeout=5000')
+    self.q=queue.SimpleQueue()
+    self.written=0
+    self.thread=threading.Thread(target=self.writer,daemon=True)
+    self.thread.start()
+
+  def newrun(self,device='',name='',**meta):
+    from time import time
+    with self.lock:
+      run=self.db.execute('INSERT INTO runs(started,device,name) VALUES (?,?,?)',(time(),device,name)).lastrowid
+    self.setmeta(run,**meta)
+    return run
+
+  def setmeta(self,run,**meta):
+    with self.lock:
+      self.db.executemany('INSERT OR REPLACE INTO meta(run_id,key,value) VALUES (?,?,?)',
+                          [(run,k,v if isinstance(v,(int,float,str)) or v==None else str(v)) for k,v in meta.items()])
+
+  def endrun(self,run):
+    from time import time
+    self.sync()
+    with self.lock: self.db.execute('UPDATE runs SET ended=? WHERE id=?',(time(),run))
+
+  # queue one raw status packet of a run, cheap enough to call from the receive loop
+  def add(self,run,t,packet):
+    self.q.put((run,t,bytes(packet)))
+
+  def row(self,run,t,p):
+    a=decode_status(p)
+    return (run,t,a.get('V'),a.get('A'),a.get('Ah'),a.get('Wh'),a.get('temp'),a.get('hh',0)*3600+a.get('mm',0)*60+a.get('ss',0))
+
+  def writer(self):
+    import queue
+    from time import monotonic
+    while True:
+      x=self.q.get()
+      rows=[];done=[]
+      deadline=monotonic()+self.FLUSHSECS
+      while True:
+        if x==None: break
+        elif isinstance(x,list): done.append(x) # sync marker
+        else: rows.append(self.row(*x))
+        if len(rows)>=self.BATCH or done: break
+        try: x=self.q.get(timeout=max(0,deadline-monotonic()))
+        except queue.Empty: break
+      if rows:
+        with self.lock:
+          self.db.execute('BEGIN')
+          self.db.executemany(self.INSERT,rows) # one prepared statement for the whole batch
+          self.db.execute('COMMIT')
+        self.written+=len(rows)
+      for d in done: d[0].set()
+      if x==None: return
+
+  # wait until everything queued so far is written
+  def sync(self):
+    import threading
+    e=threading.Event()
+    self.q.put([e])
+    e.wait()
+
+  def close(self):
+    self.q.put(None)
+    self.thread.join()
+    self.rdb.close()
+    self.db.close()
+
+  # runs with their metadata, optionally only those with all meta key=value pairs
+  def runs(self,**where):
+    q='SELECT id,started,ended,device,name FROM runs'
+    args=[]
+    for k,v in where.items():
+      q+=(' WHERE' if not args else ' AND')+' id IN (SELECT run_id FROM meta WHERE key=? AND value=?)'
+      args+=[k,v]
+    res=[]
+    for id,started,ended,device,name in self.rdb.execute(q+' ORDER BY id',args).fetchall():
+      a={'run':id,'started':started,'ended':ended,'device':device,'name':name}
+      a.update(dict(self.rdb.execute('SELECT key,value FROM meta WHERE run_id=?',(id,)).fetchall()))
+      a['nsamples']=self.rdb.execute('SELECT count(*) FROM samples WHERE run_id=?',(id,)).fetchone()[0]
+      res.append(a)
+    return res
+
+  # samples of a run in the time range [t0,t1), by the (run_id,t) index
+  def samples(self,run,t0=None,t1=None):
+    return self.rdb.execute('SELECT t,V,A,Ah,Wh,temp,runtime FROM samples WHERE run_id=? AND t>=? AND t<? ORDER BY t',
+                           (run,-1e300 if t0==None else t0,1e300 if t1==None else t1))
 
 
 
@@ -211,6 +939,430 @@ def getint16(l,n):
 
 
 
+####################
+##
+##  PACKET FRAMER
+##
+####################
+
+PROTO_SHORTACK=0x6F
+
+# frame kinds returned by the framer
+FRAME_ACK=1      # 6F, PX100 command acknowledge, 1 byte
+FRAME_PX100=2    # CA CB d1 d2 d3 CE CF, PX100 query reply, 7 bytes
+FRAME_REPLY=3    # FF 55 02 .., Atorch command reply, 8 bytes
+FRAME_STATUS=4   # FF 55 01 .., Atorch periodic status, 36 bytes
+
+# streaming framer; bytes go to a preallocated bytearray, consumed with a read cursor instead of popping/slicing,
+# frames are returned as memoryviews into the buffer - valid only until the next feed()/reserve()
+class AtorchFramer:
+  expectshort=False   # 0x6F is a valid frame start (PX100 command sent)
+  expectans=False     # 0xCA is a valid frame start (PX100 query sent)
+  ondiscard=None      # callback(memoryview) for bytes thrown away while resynchronizing
+
+  def __init__(self,size=4096):
+    self.buf=bytearray(size)
+    self.view=memoryview(self.buf)
+    self.rd=0 # read cursor
+    self.wr=0 # write cursor
+    self.frames=0
+    self.discarded=0
+    self.crcfail=0
+
+  def __len__(self):
+    return self.wr-self.rd
+
+  def clear(self):
+    self.rd=0;self.wr=0
+
+  # make room for n more bytes and return the writable area (usable for recv_into); call commit(n) after filling
+  def reserve(self,n):
+    if self.wr+n>len(self.buf):
+      rem=self.wr-self.rd
+      if rem+n>len(self.buf): # grow; a new buffer, so the already returned views stay intact
+        nb=bytearray(max(2*len(self.buf),rem+n))
+        nb[:rem]=self.view[self.rd:self.wr]
+        self.buf=nb;self.view=memoryview(nb)
+      else: self.buf[:rem]=self.buf[self.rd:self.wr] # move the unparsed tail to the front, same size, no realloc
+      self.rd=0;self.wr=rem
+    return self.view[self.wr:self.wr+n]
+
+  def commit(self,n):
+    self.wr+=n
+
+  def feed(self,data):
+    n=len(data)
+    self.reserve(n)[:]=data
+    self.wr+=n
+
+  def checkcrc(self,pos,l):
+    return ((sum(self.view[pos+2:pos+l-1])^0x44)&0xff)==self.buf[pos+l-1]
+
+  # skip garbage up to the next byte that can start a frame
+  def resync(self,skip=1):
+    buf=self.buf;rd=self.rd;wr=self.wr
+    end=buf.find(0xFF,rd+skip,wr)
+    if end<0: end=wr
+    if self.expectans:
+      n=buf.find(0xCA,rd+skip,end)
+      if n>=0: end=n
+    if self.expectshort:
+      n=buf.find(PROTO_SHORTACK,rd+skip,end)
+      if n>=0: end=n
+    self.discarded+=end-rd
+    if self.ondiscard!=None: self.ondiscard(self.view[rd:end])
+    self.rd=end
+
+  # return next complete frame as (kind,memoryview), or None when more data is needed
+  def next(self):
+    buf=self.buf
+    while self.rd<self.wr:
+      rd=self.rd;n=self.wr-rd;c=buf[rd]
+      if c==0xFF:
+        if n<3: return None
+        if buf[rd+1]==0x55:
+          t=buf[rd+2]
+          if   t==0x01: l=36;kind=FRAME_STATUS
+          elif t==0x02: l=8;kind=FRAME_REPLY
+          else: l=0
+          if l>0:
+            if n<l: return None
+            if self.checkcrc(rd,l):
+              self.rd=rd+l;self.frames+=1
+              return kind,self.view[rd:rd+l]
+            self.crcfail+=1 # can be a false sync, search again from the next byte
+      elif c==0xCA and self.expectans:
+        if n<7: return None
+        if buf[rd+1]==0xCB and buf[rd+5]==0xCE and buf[rd+6]==0xCF:
+          self.rd=rd+7;self.frames+=1
+          return FRAME_PX100,self.view[rd:rd+7]
+      elif c==PROTO_SHORTACK and self.expectshort:
+        self.rd=rd+1;self.frames+=1
+        self.expectshort=False
+        return FRAME_ACK,self.view[rd:rd+1]
+      self.resync()
+    return None
+
+
+
+
+####################
+##
+##  STATUS DECODING
+##
+####################
+
+# field layouts of the FF 55 01 status packet per ADU: name:(offset,bytes,scale), big-endian unsigned
+STATUS_LAYOUTS={
+  1:{'V':(4,3,0.1),'A':(7,3,0.001),'W':(10,3,0.1),'Wh':(13,4,10),'price':(17,3,0.01),             # AC meter
+     'freq':(20,2,0.1),'pf':(22,2,0.001),'temp':(24,2,1),'hh':(26,2,1),'mm':(28,1,1),'ss':(29,1,1),'bk':(30,1,1)},
+  2:{'V':(4,3,0.1),'A':(7,3,0.001),'Ah':(10,3,0.01),'Wh':(13,4,10),'price':(17,3,0.01),            # DC meter, DL24
+     'pf':(22,2,0.001),'temp':(24,2,1),'hh':(26,2,1),'mm':(28,1,1),'ss':(29,1,1),'bk':(30,1,1)},
+  3:{'V':(4,3,0.01),'A':(7,3,0.01),'Ah':(10,3,0.001),'Wh':(13,4,0.01),'Dp':(17,2,0.01),'Dm':(19,2,0.01), # USB meter
+     'temp':(21,2,1),'hh':(23,2,1),'mm':(25,1,1),'ss':(26,1,1),'bk':(27,1,1)},
+}
+
+# batch decoding of captured status packets into a numpy structured array, one ADU type per call
+# data: concatenated 36-byte packets, or a raw capture stream with other traffic and noise between them
+# adu: layout to use, None for the most frequent one; packets of other types and with bad checksum are dropped
+def decode_status_frames(data,adu=None,checkcrc=True):
+  import numpy as np
+  raw=np.frombuffer(data,dtype=np.uint8)
+  n=len(raw)//36
+  if n>0 and len(raw)==n*36 and (raw[0::36]==0xff).all() and (raw[1::36]==0x55).all() and (raw[2::36]==0x01).all():
+    frames=raw.reshape(n,36) # aligned capture, no copy
+    aligned=True
+  else:
+    pos=np.flatnonzero((raw[:-2]==0xff)&(raw[1:-1]==0x55)&(raw[2:]==0x01))
+    pos=pos[pos+36<=len(raw)]
+    frames=raw[pos[:,None]+np.arange(36)]
+    aligned=False
+  if checkcrc:
+    ok=((frames[:,2:35].sum(axis=1,dtype=np.uint32)^0x44)&0xff)==frames[:,35]
+    frames=frames[ok]
+    if not aligned: pos=pos[ok]
+  if not aligned and len(frames)>1: # a false sync with a valid checksum inside a packet
+    keep=np.diff(pos,prepend=-36)>=36
+    frames=frames[keep]
+  if adu==None: adu=int(np.bincount(frames[:,3]).argmax()) if len(frames)>0 else 2
+  frames=frames[frames[:,3]==adu]
+  layout=STATUS_LAYOUTS[adu]
+  dtype=np.dtype([(k,'i4' if sc==1 else 'f8') for k,(o,l,sc) in layout.items()]+[('runtime','i4')])
+  out=np.empty(len(frames),dtype=dtype)
+  for k,(o,l,sc) in layout.items():
+    v=frames[:,o].astype(np.uint32)
+    for x in range(o+1,o+l): v=(v<<8)|frames[:,x]
+    out[k]=v if sc==1 else v*sc
+  out['runtime']=out['hh']*3600+out['mm']*60+out['ss']
+  return out
+
+# precompiled layouts: ADU:(Struct over the packet, [(name,item index,3-byte field,scale)])
+# struct has no 24-bit type, 3-byte fields are unpacked as B+H and joined
+def compile_layout(layout):
+  fmt='>';fields=[];pos=0;i=0
+  for k,(o,n,sc) in sorted(layout.items(),key=lambda x:x[1][0]):
+    if o>pos: fmt+=f'{o-pos}x'
+    fmt+={1:'B',2:'H',3:'BH',4:'I'}[n]
+    fields.append((k,i,n==3,sc))
+    i+=2 if n==3 else 1
+    pos=o+n
+  return Struct(fmt+f'{36-pos}x'),fields
+
+STATUS_STRUCTS={adu:compile_layout(x) for adu,x in STATUS_LAYOUTS.items()}
+
+# decode one status packet to a dict by the ADU layout
+def decode_status(l):
+  c=STATUS_STRUCTS.get(l[3])
+  if c==None: return {}
+  st,fields=c
+  r=st.unpack_from(l)
+  a={}
+  for k,i,wide,sc in fields:
+    v=(r[i]<<16)|r[i+1] if wide else r[i]
+    a[k]=v if sc==1 else round(v*sc,6)
+  return a
+
+
+
+####################
+##
+##  CAPTURE FILES
+##
+####################
+
+# binary capture: 16-byte header, then variable-size records, little endian:
+#   head: kind|flags, body length, count, dt, span
+#   kind 1: status packet; key record: the raw 36-byte packet, else a 36-bit mask of the bytes changed since the
+#           previous status record, then those bytes
+#   kind 2: PX100 query values, [cmd][24-bit value] for the changed values; a key record has all values known
+#   flags: CAP_KEY, the body starts with twall (epoch) and tmono (monotonic), otherwise the record is dt milliseconds
+#          after the previous record
+#   count: RLE, number of identical records merged into this one (status compared without runtime and checksum),
+#          span: milliseconds from the first to the last merged one; times are the ones of the first
+# every INDEXSTEP records the next record of each kind is a key record, and the first of them goes into the sparse
+# index <file>.idx: 16-byte records [twall double][file offset uint64], decoding can start at any of them
+CAP_MAGIC=b'DL24CAP2'
+CAP_HEADER=16
+CAP_HEAD=Struct('<BBHHI')
+CAP_TIMES=Struct('<dd')
+CAP_INDEX=Struct('<dQ')
+CAP_STATUS=1
+CAP_QUERY=2
+CAP_KEY=0x80
+
+# records of a capture from offset off: (offset, head, body); stops before a partially written record
+def capscan(buf,off=CAP_HEADER):
+  n=len(buf)
+  while off+CAP_HEAD.size<=n:
+    h=CAP_HEAD.unpack_from(buf,off)
+    e=off+CAP_HEAD.size+h[1]
+    if e>n: return
+    yield off,h,buf[off+CAP_HEAD.size:e]
+    off=e
+
+def cappairs(values):
+  return b''.join(pack('>B',c)+(v&0xffffff).to_bytes(3,'big') for c,v in values)
+
+class CaptureWriter:
+  INDEXSTEP=256     # records per index entry
+
+  def __init__(self,fn):
+    import os
+    self.fn=fn
+    new=not os.path.exists(fn) or os.path.getsize(fn)<CAP_HEADER
+    self.f=open(fn,'r+b' if not new else 'w+b')
+    if new: self.f.write(CAP_MAGIC+pack('<HH4x',2,CAP_HEAD.size))
+    elif self.f.read(8)!=CAP_MAGIC: raise ValueError('not a capture file: '+fn)
+    self.end=self.f.seek(0,2)
+    if not new: # cut a partially written record, looking from the last index entry on
+      off=CAP_HEADER
+      if os.path.exists(fn+'.idx') and os.path.getsize(fn+'.idx')>=CAP_INDEX.size:
+        with open(fn+'.idx','rb') as fi:
+          fi.seek(-CAP_INDEX.size,2)
+          off=CAP_INDEX.unpack(fi.read(CAP_INDEX.size))[1]
+        if off>self.end: off=CAP_HEADER
+      self.f.seek(off)
+      buf=self.f.read()
+      self.end=off
+      for o,h,body in capscan(buf,0): self.end=off+o+CAP_HEAD.size+h[1]
+      self.f.truncate(self.end)
+    self.idx=open(fn+'.idx','ab')
+    self.last={}      # kind: [file offset, head list, comparison key, tmono]
+    self.frame=None   # last written status packet
+    self.values={}    # last written query values
+    self.twall=None   # times of the last record, as the reader adds them up
+    self.tmono=None
+    self.sinceidx=self.INDEXSTEP
+    self.needkey={CAP_STATUS,CAP_QUERY}
+
+  # merge a repeat into the previous record of the kind; not across an index point
+  def merge(self,kind,key,tmono):
+    l=self.last.get(kind)
+    if l==None or kind in self.needkey or l[2]!=key or l[1][2]>=0xffff: return False
+    h=l[1];h[2]+=1;h[4]=min(0xffffffff,round((tmono-l[3])*1000))
+    self.f.seek(l[0])
+    self.f.write(CAP_HEAD.pack(*h))
+    self.f.flush()
+    return True
+
+  # milliseconds from the previous record, None when a key record has to be written
+  def delta(self,kind,twall,tmono):
+    if kind in self.needkey or self.tmono==None: return None
+    d=round((tmono-self.tmono)*1000)
+    if not 0<=d<=0xffff or abs(twall-self.twall-d/1000)>0.05: return None # long pause, wall clock step
+    return d
+
+  def append(self,kind,d,body,key,twall,tmono):
+    if self.sinceidx>=self.INDEXSTEP:
+      self.idx.write(CAP_INDEX.pack(twall,self.end))
+      self.idx.flush()
+      self.sinceidx=0
+    if d==None:
+      body=CAP_TIMES.pack(twall,tmono)+body
+      h=[kind|CAP_KEY,len(body),1,0,0]
+      self.twall=twall;self.tmono=tmono
+      self.needkey.discard(kind)
+    else:
+      h=[kind,len(body),1,d,0]
+      self.twall+=d/1000;self.tmono+=d/1000
+    self.f.seek(self.end)
+    self.f.write(CAP_HEAD.pack(*h)+body)
+    self.f.flush()
+    self.last[kind]=[self.end,h,key,tmono]
+    self.end+=CAP_HEAD.size+len(body)
+    self.sinceidx+=1
+    if self.sinceidx>=self.INDEXSTEP: self.needkey={CAP_STATUS,CAP_QUERY}
+
+  def status(self,p,twall=None,tmono=None):
+    from time import time
+    if twall==None: twall=time()
+    if tmono==None: tmono=monotonic()
+    p=bytes(p)
+    layout=STATUS_LAYOUTS.get(p[3],STATUS_LAYOUTS[2])
+    o=layout['hh'][0];e=layout['ss'][0]+1
+    key=p[:o]+p[e:35] # runtime and checksum always change
+    if self.merge(CAP_STATUS,key,tmono): return
+    d=self.delta(CAP_STATUS,twall,tmono)
+    if d==None or self.frame==None or len(p)!=len(self.frame): d=None;body=p
+    else:
+      mask=0;ch=bytearray()
+      for i in range(0,len(p)):
+        if p[i]!=self.frame[i]: mask|=1<<i;ch.append(p[i])
+      body=mask.to_bytes(5,'little')+ch
+    self.frame=p
+    self.append(CAP_STATUS,d,body,key,twall,tmono)
+
+  # values: {cmd:raw value}; only the changed ones are stored
+  def query(self,values,twall=None,tmono=None):
+    from time import time
+    if twall==None: twall=time()
+    if tmono==None: tmono=monotonic()
+    p=cappairs((c,v) for c,v in values.items() if self.values.get(c)!=v)
+    self.values.update(values)
+    if self.merge(CAP_QUERY,p,tmono): return
+    d=self.delta(CAP_QUERY,twall,tmono)
+    self.append(CAP_QUERY,d,p if d!=None else cappairs(self.values.items()),p,twall,tmono)
+
+  def close(self):
+    self.f.close()
+    self.idx.close()
+
+
+class CaptureReader:
+  def __init__(self,fn):
+    import mmap,os
+    self.f=open(fn,'rb')
+    self.mm=mmap.mmap(self.f.fileno(),0,access=mmap.ACCESS_READ)
+    if self.mm[:8]!=CAP_MAGIC: raise ValueError('not a capture file: '+fn)
+    self.idx=None;self.nidx=0
+    if os.path.exists(fn+'.idx') and os.path.getsize(fn+'.idx')>=CAP_INDEX.size:
+      self.fi=open(fn+'.idx','rb')
+      self.idx=mmap.mmap(self.fi.fileno(),0,access=mmap.ACCESS_READ)
+      self.nidx=len(self.idx)//CAP_INDEX.size
+
+  # offset to start decoding for time t: the last index entry before t, bisected
+  def find(self,t):
+    if self.idx==None: return CAP_HEADER
+    a=0;b=self.nidx
+    while a<b:
+      m=(a+b)//2
+      if CAP_INDEX.unpack_from(self.idx,m*CAP_INDEX.size)[0]<t: a=m+1
+      else: b=m
+    if a==0: return CAP_HEADER
+    return CAP_INDEX.unpack_from(self.idx,(a-1)*CAP_INDEX.size)[1]
+
+  # decoded records in [t0,t1): dicts with time, count, duration and values
+  def range(self,t0=None,t1=None):
+    frame=None;twall=tmono=None
+    for off,(kf,l,count,d,span),body in capscan(self.mm,CAP_HEADER if t0==None else self.find(t0)):
+      kind=kf&~CAP_KEY
+      if kf&CAP_KEY:
+        twall,tmono=CAP_TIMES.unpack_from(body)
+        body=body[CAP_TIMES.size:]
+      elif twall==None: continue # no key record yet
+      else: twall+=d/1000;tmono+=d/1000
+      if kind==CAP_STATUS:
+        if kf&CAP_KEY: frame=bytes(body)
+        elif frame==None: continue
+        else:
+          frame=bytearray(frame);m=int.from_bytes(body[:5],'little');j=5
+          for i in range(0,len(frame)):
+            if m>>i&1: frame[i]=body[j];j+=1
+          frame=bytes(frame)
+      if t0!=None and twall<t0: continue
+      if t1!=None and twall>=t1: return
+      a={'t':twall,'count':count,'dt':round(span/1000,3)}
+      if kind==CAP_STATUS: a['adu']=frame[3];a.update(decode_status(frame))
+      elif kind==CAP_QUERY:
+        a['query']={body[x]:int.from_bytes(body[x+1:x+4],'big') for x in range(0,len(body)-3,4)}
+      yield a
+
+  def close(self):
+    self.mm.close()
+    if self.idx!=None: self.idx.close();self.fi.close()
+    self.f.close()
+
+
+
+
+# smoothed round-trip time and variance of one connection, giving the reply timeout (RFC 6298 style)
+# samples only from requests answered on the first try; every timeout doubles the timeout until the next sample
+class RttEstimator:
+  alpha=1/8
+  beta=1/4
+  k=4
+  granularity=0.01
+
+  def __init__(self,initial=1.0,minrto=0.05,maxrto=3.0,backoff=2.0):
+    self.minrto=minrto
+    self.maxrto=maxrto
+    self.backoff=backoff
+    self.srtt=None
+    self.rttvar=None
+    self.rto=min(max(initial,minrto),maxrto)
+    self.samples=0
+    self.timeouts=0
+
+  def sample(self,rtt):
+    if self.srtt==None: self.srtt=rtt;self.rttvar=rtt/2
+    else:
+      self.rttvar=(1-self.beta)*self.rttvar+self.beta*abs(self.srtt-rtt)
+      self.srtt=(1-self.alpha)*self.srtt+self.alpha*rtt
+    self.rto=min(max(self.srtt+max(self.k*self.rttvar,self.granularity),self.minrto),self.maxrto)
+    self.samples+=1
+
+  def timedout(self):
+    self.rto=min(self.rto*self.backoff,self.maxrto)
+    self.timeouts+=1
+
+# retry policies on top of the estimator; linktimeout is the silence after which a TCP link is reconnected
+RETRYPOLICIES={
+  'normal': {'retries':3,'retriescmd':3,'initial':1.0,'minrto':0.05,'maxrto':3.0,'backoff':2.0,'linktimeout':5},
+  'robust': {'retries':6,'retriescmd':5,'initial':2.0,'minrto':0.3,'maxrto':10.0,'backoff':2.0,'linktimeout':15},
+  'noretry':{'retries':1,'retriescmd':1,'initial':1.0,'minrto':0.05,'maxrto':3.0,'backoff':2.0,'linktimeout':5},
+}
+
+
 class Instr_Atorch:
   #verbcmd=True
   #verbcom=True
@@ -229,17 +1381,14 @@ class Instr_Atorch:
 
   retries=3 # command send retries, low level
   retriescmd=3 # setting command retries
-#  waitretries=20 # response wait retries
-  waitretries=50 # response wait retries
-  retrydelay=0.05 # response wait
+  policy='normal'     # retry policy from RETRYPOLICIES, reply timeouts come from the RTT estimate
+  batchmax=8          # max. PX100 queries sent back-to-back in one burst
+  wiretime=14*10/DEFAULT_BAUDRATE # request+reply bytes on the wire per PX100 query
 
   default_minimize=True  # True for wireless, False for wired
 
 
-  expectshort=False   # expect short single-byte reply confirmation
-  expectans=False
-  packet=[]
-  pacletlong=[]
+  packet=None        # last reply packet
   longpacketcnt=0
   longpacketcntold=0
 
@@ -251,7 +1400,7 @@ class Instr_Atorch:
   instrtype=None
   ADU=2 # read from instrtype, this is default; possibly specify in config
 
-  PROTO_SHORTACK=0x6F
+  PROTO_SHORTACK=PROTO_SHORTACK
 
   CMD_A_CLRALL=0x01
   CMD_A_CLRCAP=0x02
@@ -286,17 +1435,76 @@ class Instr_Atorch:
   CMD_GETSETTIMER=0x19
 
 
+  # cached values, name:(value,monotonic time); fed by confirmed writes, query replies and status packets
+  # cacheages: per-field max. age in seconds for serving reads from the cache, 0 to always query
+  cacheages={'Iset':5,'Vcut':5,'out':0.5,'V':1.5,'A':1.5,'temp':1.5,'Ah':1.5,'Wh':1.5}
+  settingsage=30      # minimized reads (STATE:M) take out/Iset/Vcut from the cache up to this old, the front panel may change them
+
+  recorder=None       # CaptureWriter for status packets and query results
+  rollup=None         # Rollup history of the status packets
+  store=None          # SampleStore for the status packets
+  storerun=None       # run id in the store
+  laststatus=None     # monotonic time of the last status packet
+
+  # write-behind queue of setpoints from commands, name:target; flushed by flush(), before queries and after writedelay
+  writequeue=True     # False: write at once
+  writedelay=0.2      # seconds a queued write may wait
+
   def __init__(self):
-    #self.buf=Queue()
-    self.buf=[]
-    self.packet=[]
-    self.packetlong=[]
+    self.framer=AtorchFramer()
+    self.framer.ondiscard=self.showdiscard
+    metrics.collect(self.framerstats)
+    self.packet=None
     self.state={}
-    pass
+    self.cache={}
+    self.pending={}
+    self.pendingdeadline=0
+    self.cacheages=dict(self.cacheages)
+    self.QUERYFIELDS={ # query: (cache name, divider to natural units)
+      self.CMD_GETONOFF:('out',1),self.CMD_GETV:('V',1000),self.CMD_GETA:('A',1000),
+      self.CMD_GETMAH:('Ah',1000),self.CMD_GETMWH:('Wh',1000),self.CMD_GETTEMP:('temp',1),
+      self.CMD_GETSETCURRENT:('Iset',100),self.CMD_GETSETCUTOFF:('Vcut',100)}
+    self.setpolicy(self.policy)
+
+  def setpolicy(self,name):
+    p=RETRYPOLICIES[name]
+    self.policy=name
+    self.retries=p['retries']
+    self.retriescmd=p['retriescmd']
+    self.rtt=RttEstimator(initial=p['initial'],minrto=p['minrto'],maxrto=p['maxrto'],backoff=p['backoff'])
+    if self.comm!=None and hasattr(self.comm,'default_timeout'): self.comm.default_timeout=p['linktimeout']
+
+  def framerstats(self):
+    f=self.framer
+    return [('dl24_frames_total',None,f.frames),('dl24_discarded_bytes_total',None,f.discarded),('dl24_crc_failures_total',None,f.crcfail)]
+
+  def cacheset(self,name,val):
+    if val!=None: self.cache[name]=(val,monotonic())
+
+  # cached value if younger than maxage (default per-field), else None
+  def cacheget(self,name,maxage=None):
+    if maxage==None: maxage=self.cacheages.get(name,0)
+    c=self.cache.get(name)
+    if c==None or monotonic()-c[1]>maxage: return None
+    return c[0]
+
+  # drop given cached values, all if none given
+  def invalidate(self,*names):
+    if names==(): self.cache={};return
+    for x in names: self.cache.pop(x,None)
+
+  # set max. cache age: "secs" for all fields or "name=secs"
+  def setcacheage(self,s):
+    a=s.split('=')
+    if len(a)==1:
+      t=float(a[0])
+      for x in self.cacheages: self.cacheages[x]=t
+    else: self.cacheages[a[0]]=float(a[1])
 
   def initport(self,comm):
     #print('INITPORT')
     self.comm=comm
+    self.setpolicy(self.policy) # new connection, new estimate
 
   def connect(self):
     self.comm.connect()
@@ -306,8 +1514,11 @@ class Instr_Atorch:
 #    self.comm.close()
 
   def close(self):
+    self.flush()
     if self.offoff: self.setOFF();
     self.comm.close()
+    if self.recorder!=None: self.recorder.close()
+    if self.store!=None: self.store.endrun(self.storerun);self.store.close()
 
 
 
@@ -398,70 +1609,42 @@ class Instr_Atorch:
 
 
 
-  def flushbuf(self,discard=False,cmt=''):
-    disc=False # was anything discarded?
-    if discard:
-      disc=True
-      print(f'discard: {cmt} {self.buf.pop(0):02x}',end='',file=stdlog)
-    while len(self.buf)>0:
-      if (self.expectshort and self.buf[0]==self.PROTO_SHORTACK) \
-      or (self.expectans and self.buf[0]==0xCA) \
-      or (self.buf[0]==0xff):
-         if disc: print(file=stdlog)
-         return True
-      if not disc: disc=True;print('discard:',end='',file=stdlog)
-      print(f' {self.buf.pop(0):02x}',end='',file=stdlog)
-    if disc: print(file=stdlog)
-    return False
+  def showdiscard(self,p):
+    print('discard:',' '.join(f'{x:02x}' for x in p),file=stdlog)
 
+  # before a request: handle the status packets already received and drop stale replies;
+  # a partial frame at the end is kept, it may be a status packet still arriving
   def clearbuf(self):
-    self.buf=[]
-
-  def recvpacket(self):#
-    if not self.flushbuf(): return False
-
-    if self.buf[0]==self.PROTO_SHORTACK:
-      self.packet=[self.buf.pop(0)]
-      self.expectshort=False
-      self.showpacket(self.packet,name='short ANS')
+    avail=self.comm.avail()
+    if avail>0: self.framer.feed(self.comm.recv(avail))
+    while self.recvpacket(): pass
+    self.packet=None
+
+  # parse buffered data; status packets are handled on the fly, stops at the first reply packet
+  def recvpacket(self):
+    while True:
+      f=self.framer.next()
+      if f==None: return False
+      kind,p=f
+      if kind==FRAME_STATUS:
+        self.handlelongpacket(p)
+        continue
+      self.packet=bytes(p) # replies are used after the buffer moves on, keep a copy of the few bytes
+      if kind==FRAME_ACK: self.showpacket(self.packet,name='short ANS')
+      elif kind==FRAME_PX100: self.showpacket(self.packet,name='ANS: ')
+      else:
+        if p[3]==1: s='reply'
+        elif p[3]==3: s='reply:UNSUPPORTED'
+        else: s=f'reply:UNKNOWN:{p[3]:02x}'
+        self.showpacket(self.packet,name=s,check=True)
       return True
 
-    while len(self.buf)>0:
-      if self.buf[0]==0xCA:
-        if len(self.buf)<7: return False # too short
-        if self.buf[1]!=0xCB or self.buf[5]!=0xCE or self.buf[6]!=0xCF:
-          self.flushbuf(discard=True,cmt='in_shortreply');continue
-        self.packet=self.buf[:7].copy()
-        self.buf=self.buf[7:]
-        self.showpacket(self.packet,name='ANS: ')
-        return True
-      if self.buf[0]==0xFF:
-        if len(self.buf)<3: return False
-        if self.buf[1]==0x55: #self.flushbuf(discard=True,cmt='2');continue
-          if self.buf[2]==0x01: # FF 55 01 - repeated status message
-            if len(self.buf)<36: return False
-            self.packetlong=self.buf[:36].copy()
-            self.buf=self.buf[36:]
-#            self.showpacket(self.packetlong,name='long status',check=True)
-            if self.atorch_check_crc(self.packetlong): return True
-            self.packetlong=[]
-            return False
-          if self.buf[2]==0x02: # FF 55 02 - 8-byte command response
-            if len(self.buf)<8: return False
-            self.packet=self.buf[:8].copy()
-            self.buf=self.buf[8:]
-            if self.packet[3]==1: s='reply'
-            elif self.packet[3]==3: s='reply:UNSUPPORTED'
-            else: s=f'reply:UNKNOWN:{self.packet[3]:02x}'
-            self.showpacket(self.packet,name=s,check=True)
-            if self.atorch_check_crc(self.packet): return True
-            self.packet=[]
-            return False
-      self.flushbuf(discard=True,cmt='in_statusmsg')
-    return False
-
 
-  def handlelongpacket(self):
+  def handlelongpacket(self,l):
+    if self.recorder!=None: self.recorder.status(l)
+    if self.store!=None:
+      from time import time
+      self.store.add(self.storerun,time(),l)
 #                  4                8                12               16               20               24               28               32
 # [FF][55][01][02] [00][00][00][00] [00][00][00][00] [12][00][00][00] [00][00][00][00] [00][00][00][00] [00][17][00][00] [0A][33][3c][00] [00][00][00][E1]
 # [FF][55][01][02] [00][00][33][00] [00][00][00][00] [12][00][00][00] [00][00][00][00] [00][00][00][00] [00][17][00][00] [0A][33][3c][00] [00][00][00][9C]
@@ -470,19 +1653,21 @@ class Instr_Atorch:
 #              03   -voltage--  -milliamps-  -amphours--  ----energy-----   usbd+   usbd-   -temp-  --hhhh---mm--ss  bk
 #             ADU      0.1v       0.001a       0.01Ah
     self.longpacketcnt+=1
+    t=monotonic()
+    if self.laststatus!=None: metrics.observe('dl24_status_jitter_seconds',abs(t-self.laststatus-1),buckets=metrics.JITTERBUCKETS)
+    self.laststatus=t
     a=self.state
-    l=self.packetlong
     self.instrtype=l[3]
     self.ADU=self.instrtype
-    # for ADU=2; todo, other decoding
-    a['V']=getint24(l,4)/10
-    a['A']=getint24(l,7)/1000
-    a['temp']=getint16(l,24)
-    #a['aH']=getint24(l,10)/100
-    #a['energy']=getint24(l,13)
-    #a['price']=getint24(l,16)/100
-    #print('state',a)
-    self.packetlong=[]
+    d=decode_status(l if l[3] in STATUS_STRUCTS else bytes(l[:3])+b'\x02'+bytes(l[4:])) # unknown ADU as DL24
+    d['runtime']=d.pop('hh')*3600+d.pop('mm')*60+d.pop('ss')
+    a.update(d)
+    for x in ['V','A','temp','Ah','Wh']:
+      if x in d: self.cacheset(x,d[x])
+    if d['A']>0: self.cacheset('out',1) # current flows, the output is on
+    if self.rollup!=None:
+      from time import time
+      self.rollup.add(time(),a['V'],a['A'],a['temp'])
 
   def gotupdate(self):
     if self.longpacketcnt==self.longpacketcntold: return False
@@ -490,58 +1675,161 @@ class Instr_Atorch:
     return True
 
   def recvdata(self):
+    if self.pending and monotonic()>=self.pendingdeadline: self.flush()
     avail=self.comm.avail()
     #print(avail)
-    if avail==0: return False
-    r=self.comm.recv(avail)
-    self.showpacket(r,name='RECV:',force=self.verbcomsr)
-    for x in r: self.buf.append(x)
+    if avail>0:
+      r=self.comm.recv(avail)
+      self.showpacket(r,name='RECV:',force=self.verbcomsr)
+      self.framer.feed(r)
+    elif len(self.framer)==0: return False
     r=self.recvpacket()
-    if r and self.packetlong!=[]: self.handlelongpacket();r=False
     if self.verbcom: print('receivedAns:',r,file=stdlog)
     return r
 
 
-  def waitreply(self,expectshort=False,retries=0):
-    #if retries<1: retries=self.waitretries
-    if retries<1: retries=self.waitretries
-    for t in range(0,retries):
-      sleep(self.retrydelay)
-      self.packet=[]
-      self.recvdata()
-      if self.packet!=[]:
+  # wait for a reply packet until timeout, default the current retransmit timeout
+  def waitreply(self,expectshort=False,timeout=None):
+    if timeout==None: timeout=self.rtt.rto
+    deadline=monotonic()+timeout
+    while True:
+      self.packet=None
+      if self.recvdata() and self.packet!=None:
         #self.showpacket(self.packet,name='wait:',force=True)
         if self.packet[0]==self.PROTO_SHORTACK and not expectshort: continue
         return True
+      t=deadline-monotonic()
+      if t<=0: break
+      self.comm.wait(t)
     print('REPLY TIMEOUT',file=stdlog)
     return False
 
   def send_px100cmd_raw(self,cmd,d=[0,0]):
     packet=pack('>BBBBBB',0xb1,0xb2,cmd,d[0],d[1],0xb6)
+    label=f'cmd="{cmd:02x}"'
     for t in range(0,self.retries):
-      if cmd<0x10: self.expectshort=True
-      else:        self.expectans=True
+      if cmd<0x10: self.framer.expectshort=True
+      else:        self.framer.expectans=True
       self.showpacket(packet,name='SEND:',force=self.verbcomsr)
-      sleep(self.retrydelay)
       self.clearbuf()
+      if t>0: metrics.inc('dl24_retries_total',1,label)
+      t0=monotonic()
       self.comm.send(packet)
-      if self.waitreply(expectshort=(cmd<0x10), retries=self.waitretries*(t+1)): return True
+      if self.waitreply(expectshort=(cmd<0x10)):
+        dt=monotonic()-t0
+        if t==0: self.rtt.sample(dt) # a reply after a retry may answer either request
+        metrics.observe('dl24_rtt_seconds',dt,label)
+        return True
+      self.rtt.timedout()
+      metrics.inc('dl24_timeouts_total',1,label)
     return False
 
+  # collect up to n PX100 replies; the timeout restarts with every reply received
+  # arrival times of the replies are left in self.replytimes, self.gotack tells if a short ack came in between
+  # ack: also wait for the short ack of a write sent behind the queries
+  def waitreplies(self,n,timeout,ack=False):
+    res=[]
+    self.replytimes=[]
+    self.gotack=False
+    deadline=monotonic()+timeout+n*self.wiretime
+    while len(res)<n or (ack and not self.gotack):
+      self.packet=None
+      if self.recvdata() and self.packet!=None:
+        if self.packet[0]==0xCA:
+          res.append(self.packet);self.replytimes.append(monotonic())
+          deadline=monotonic()+timeout
+        elif self.packet[0]==self.PROTO_SHORTACK: self.gotack=True
+        continue
+      t=deadline-monotonic()
+      if t<=0: break
+      self.comm.wait(t)
+    return res
+
+  # read and drop replies for timeout seconds, status packets are still handled
+  def drain(self,timeout):
+    deadline=monotonic()+timeout
+    while True:
+      self.packet=None
+      if self.recvdata(): continue
+      t=deadline-monotonic()
+      if t<=0: break
+      self.comm.wait(t)
+    self.packet=None
+
+  # pipelined PX100 queries: requests are written back-to-back, replies matched in order; replies carry no
+  # command, so after a lost request or reply the order cannot be trusted and the whole part is dropped, then
+  # input is discarded for one more timeout so a late reply cannot be taken for the next request
+  # the ones left are sent again one at a time, up to self.retries rounds; returns {cmd:value}, unanswered ones are missing
+  def px100_query_batch(self,cmds):
+    if self.pending: self.flush()
+    res={}
+    todo=list(cmds)
+    for t in range(0,self.retries):
+      done=[]
+      step=self.batchmax if t==0 else 1
+      for n in range(0,len(todo),step):
+        part=todo[n:n+step]
+        packet=b''.join(pack('>BBBBBB',0xb1,0xb2,c,0,0,0xb6) for c in part)
+        self.clearbuf()
+        self.framer.expectans=True
+        self.showpacket(packet,name='SEND:',force=self.verbcomsr)
+        if t>0:
+          for c in part: metrics.inc('dl24_retries_total',1,f'cmd="{c:02x}"')
+        t0=monotonic()
+        self.comm.send(packet)
+        r=self.waitreplies(len(part),self.rtt.rto)
+        if r: self.rtt.sample(self.replytimes[0]-t0) # late replies of earlier sends are drained below
+        if len(r)<len(part):
+          print(f'REPLY TIMEOUT ({len(part)-len(r)} of {len(part)})',file=stdlog)
+          self.drain(self.rtt.rto) # as long as was waited for them
+          self.rtt.timedout()
+          for c in part: metrics.inc('dl24_timeouts_total',1,f'cmd="{c:02x}"')
+          continue
+        for c,p,tr in zip(part,r,self.replytimes):
+          metrics.observe('dl24_rtt_seconds',tr-t0,f'cmd="{c:02x}"')
+          self.showpacket(p[2:5],name=f'PX100-value ({c:02x})')
+          res[c]=getint24(p,2)
+          if c in self.QUERYFIELDS: self.cacheset(self.QUERYFIELDS[c][0],res[c]/self.QUERYFIELDS[c][1])
+          done.append(c)
+      todo=[c for c in todo if c not in done]
+      if todo==[]: break
+    for c in todo: print(f'ERR: no PX100 response ({c:02x})',file=stdlog)
+    if self.recorder!=None and res: self.recorder.query(res)
+    return res
+
   def send_atorch_raw(self,cmd,d=[0,0,0,0]): # second byte, d[1], seems to always be 0
+    if self.pending: self.flush()
     # FF 55 11 <adu> <a2> <a3> 00 <a4> <a5> <checksum>
     for t in range(0,self.retries):
       packet=pack('>BBBBBBBBB',0xff,0x55,0x11,self.ADU, cmd,d[0],d[1],d[2],d[3])
       sum=self.atorch_get_crc(packet[2:])
       packet=packet+pack('>B',sum)
       self.showpacket(packet,name='SEND:',force=self.verbcomsr)
-      sleep(self.retrydelay)
       self.clearbuf()
+      label=f'cmd="a{cmd:02x}"'
+      if t>0: metrics.inc('dl24_retries_total',1,label)
+      t0=monotonic()
       self.comm.send(packet)
-      if self.waitreply(): return True
+      if self.waitreply():
+        dt=monotonic()-t0
+        if t==0: self.rtt.sample(dt)
+        metrics.observe('dl24_rtt_seconds',dt,label)
+        return True
+      self.rtt.timedout()
+      metrics.inc('dl24_timeouts_total',1,label)
     return False
 
-  def px100_query(self,cmd,id='',div=1):
+  # maxage>0 serves the value from the cache when fresh enough
+  def px100_query(self,cmd,id='',div=1,maxage=0):
+    if self.pending: self.flush()
+    f=self.QUERYFIELDS.get(cmd)
+    if f!=None and maxage>0:
+      val=self.cacheget(f[0],maxage)
+      if val!=None:
+        if self.verbcom: print(f'cached PX100 value ({id})',file=stdlog)
+        val=round(val*f[1])
+        if div!=1: return val/div
+        return val
     if self.verbcom: print(f'sending PX100 query ({id})',file=stdlog)
     r=self.send_px100cmd_raw(cmd)
     if not r:
@@ -549,38 +1837,73 @@ class Instr_Atorch:
       return None
     if self.packet[0]!=0xCA or self.packet[1]!=0xCB or self.packet[5]!=0xCE or self.packet[6]!=0xCF:
       self.showpacket(self.packet,name=f'ERR: bad PX100 response ({id})',force=True)
-      self.packet=[]
+      self.packet=None
       return None
     self.showpacket(self.packet[2:5],name=f'PX100-value ({id})')
     val=getint24(self.packet,2)
-    self.packet=[]
+    self.packet=None
+    if f!=None: self.cacheset(f[0],val/f[1])
+    if self.recorder!=None: self.recorder.query({cmd:val})
     if div!=1: return val/div
     return val
 
 
+  # PX100 set command with queries written right behind it, for measuring just after a change; no retries
+  # returns (acknowledged, {cmd:value}, send time), no values unless all queries were answered (see px100_query_batch)
+  # reply arrival times are in self.replytimes
+  # setfirst=False: the queries go first and the set right behind them, measuring before it takes effect
+  def px100_setquery(self,cmd,d,queries,setfirst=True):
+    if self.pending: self.flush()
+    s=pack('>BBBBBB',0xb1,0xb2,cmd,d[0],d[1],0xb6)
+    q=b''.join(pack('>BBBBBB',0xb1,0xb2,c,0,0,0xb6) for c in queries)
+    packet=s+q if setfirst else q+s
+    self.clearbuf()
+    self.framer.expectshort=True
+    self.framer.expectans=True
+    self.showpacket(packet,name='SEND:',force=self.verbcomsr)
+    t0=monotonic()
+    self.comm.send(packet)
+    r=self.waitreplies(len(queries),self.rtt.rto,ack=not setfirst)
+    if len(r)<len(queries):
+      print(f'REPLY TIMEOUT ({len(queries)-len(r)} of {len(queries)})',file=stdlog)
+      return self.gotack,{},t0
+    res={c:getint24(p,2) for c,p in zip(queries,r)}
+    for c,v in res.items():
+      if c in self.QUERYFIELDS: self.cacheset(self.QUERYFIELDS[c][0],v/self.QUERYFIELDS[c][1])
+    return self.gotack,res,t0
+
   def float2pair(self,f):
-    int1=int(f)
-    int2=int((f-int1)*100)
-    return [int1,int2]
+    n=round(f*100) # not truncated, 2.3 would become 2.29
+    return [n//100,n%100]
 
+  # acknowledged writes go to the cache
   def cmd_setcurrent(self,val=0):
     r=self.send_px100cmd_raw(self.CMD_SETCURRENT,self.float2pair(val))
-    if not r: print('ERR: cannot send command!',file=stdlog)
+    if not r: print('ERR: cannot send command!',file=stdlog);self.invalidate('Iset')
+    else: self.cacheset('Iset',val)
+    return r
 
   def cmd_setcutoff(self,val=0):
     r=self.send_px100cmd_raw(self.CMD_SETCUTOFF,self.float2pair(val))
-    if not r: print('ERR: cannot send command!',file=stdlog)
+    if not r: print('ERR: cannot send command!',file=stdlog);self.invalidate('Vcut')
+    else: self.cacheset('Vcut',val)
+    return r
 
   def cmd_setonoff(self,val=0):
     r=self.send_px100cmd_raw(self.CMD_ONOFF,[val,0])
-    if not r: print('ERR: cannot send command!',file=stdlog)
+    if not r: print('ERR: cannot send command!',file=stdlog);self.invalidate('out')
+    else: self.cacheset('out',val)
+    return r
 
   def cmd_resetcounters(self):
+    self.invalidate('Ah','Wh')
     r=self.send_px100cmd_raw(self.CMD_RESET)
     if not r: print('ERR: cannot send command!',file=stdlog)
+    return r
 
-  def cmd_getonoff(self):
-    res=self.px100_query(self.CMD_GETONOFF,id='onoff')
+  def cmd_getonoff(self,maxage=None):
+    if maxage==None: maxage=self.cacheages['out']
+    res=self.px100_query(self.CMD_GETONOFF,id='onoff',maxage=maxage)
     self.out=res
     return res
 
@@ -590,11 +1913,13 @@ class Instr_Atorch:
   def cmd_getamp(self,div=1000):
     return self.px100_query(self.CMD_GETA,id='setcurrent',div=div)
 
-  def cmd_getsetcurrent(self):
-    return self.px100_query(self.CMD_GETSETCURRENT,id='setcurrent',div=100)
+  def cmd_getsetcurrent(self,maxage=None):
+    if maxage==None: maxage=self.cacheages['Iset']
+    return self.px100_query(self.CMD_GETSETCURRENT,id='setcurrent',div=100,maxage=maxage)
 
-  def cmd_getsetcutoff(self):
-    return self.px100_query(self.CMD_GETSETCUTOFF,id='setcutoff',div=100)
+  def cmd_getsetcutoff(self,maxage=None):
+    if maxage==None: maxage=self.cacheages['Vcut']
+    return self.px100_query(self.CMD_GETSETCUTOFF,id='setcutoff',div=100,maxage=maxage)
 
   def cmd_getah(self,div=1000):
     return self.px100_query(self.CMD_GETMAH,id='Ah',div=div)
@@ -606,47 +1931,102 @@ class Instr_Atorch:
     return self.px100_query(self.CMD_GETTEMP,id='temp')
 
   def cmd_button(self,butt):
+    self.invalidate() # buttons can change anything
     return self.send_atorch_raw(butt,d=[0,0,0,0])
 
 
-  def cmd_readstate(self,energy=True,limits=True,temp=True,timestr=None,short=True,listenonly=False):
+  # cached=True serves also measured values from recent status packets; settings come from the cache when fresh anyway
+  def cmd_readstate(self,energy=True,limits=True,temp=True,timestr=None,short=True,listenonly=False,cached=False):
+    if self.pending: self.flush()
     #return self.state
     a={}
 
     if timestr!=None: a['time']=timestr
-    if not listenonly:
-      a['out']=self.cmd_getonoff()
-      self.out=a['out']
-
+    if listenonly:
+      a.update(self.state)
+      return a
+
+    # name, query, divider; all queries go out in one pipelined batch
+    q=[('out',self.CMD_GETONOFF,1),('V',self.CMD_GETV,1000)]
+    if not short:
+      q+=[('A',self.CMD_GETA,1000)]
+      if energy: q+=[('Ah',self.CMD_GETMAH,1000),('Wh',self.CMD_GETMWH,1000)]
+      if limits: q+=[('Iset',self.CMD_GETSETCURRENT,100),('Vcut',self.CMD_GETSETCUTOFF,100)]
+      if temp: q+=[('temp',self.CMD_GETTEMP,1)]
+    r={}
+    for name,cmd,div in q:
+      if name in ['out','Iset','Vcut'] or cached:
+        # minimized: the settings change mostly by our writes, re-read now and then, the measurements come with every status report
+        v=self.cacheget(name,maxage=self.settingsage if cached and name in ['out','Iset','Vcut'] else None)
+        if name=='out' and v==1 and cached and self.state.get('A')==0: v=None # maybe switched off by the cutoff, ask
+        if v!=None: r[cmd]=round(v*div)
+    r.update(self.px100_query_batch([x[1] for x in q if x[1] not in r]))
+    def val(cmd,div):
+      if cmd not in r: return None
+      return r[cmd] if div==1 else r[cmd]/div
+    a['out']=val(self.CMD_GETONOFF,1)
+    self.out=a['out']
     a.update(self.state)
-    if listenonly: return a
-
-    a['V']=self.cmd_getvolt()
-    if short: return a
-
-    a['A']=self.cmd_getamp()
-    if energy:
-      a['Ah']=self.cmd_getah()
-      a['Wh']=self.cmd_getwh()
-    if limits:
-      a['Iset']=self.cmd_getsetcurrent()
-      a['Vcut']=self.cmd_getsetcutoff()
-    if temp:
-      a['temp']=self.cmd_gettemp()
+    for name,cmd,div in q[1:]: a[name]=val(cmd,div)
     return a
 
 
   def setOnOff(self,val,verify=True):
+    if self.pending: self.flush()
     if val!=0 and val!=1: val=0 # todo, error
+    if self.cacheget('out')==val: return True
     for x in range(0,self.retriescmd):
-      self.cmd_setonoff(val)
-      if not verify: return True
-      res=self.cmd_getonoff()
+      r=self.cmd_setonoff(val)
+      if not verify: return r
+      res=self.cmd_getonoff(maxage=0)
       if res==val: return True
       print(f'ERR: cannot set output, desired={val}, actual={res}')
     print('ERR: output set failed')
     return False
 
+  # queue a setpoint: name Iset, Vcut or out; a later one replaces it, rel adds to the queued or current target
+  def queueset(self,name,val,rel=False):
+    if rel:
+      base=self.pending.get(name)
+      if base==None and name=='Iset': base=self.cmd_getsetcurrent()
+      if base==None: print('ERR: cannot read current for relative set');return False
+      val=val+base
+    if name=='Iset': val=min(max(round(val,2),0),CURRENT_LIMIT)
+    elif name=='Vcut': val=min(max(round(val,2),0),255.2)
+    if not self.writequeue:
+      if name=='Iset': return self.setamp(val,False)
+      if name=='Vcut': return self.setcutoff(val)
+      return self.setOnOff(val)
+    if not self.pending: self.pendingdeadline=monotonic()+self.writedelay
+    self.pending[name]=val
+    return True
+
+  # write the queued setpoints, then verify them all with one batch of read-backs; False if any failed
+  def flush(self):
+    p=self.pending
+    if not p: return True
+    self.pending={}
+    writes={'Vcut':self.cmd_setcutoff,'Iset':self.cmd_setcurrent,'out':self.cmd_setonoff}
+    readback={'out':self.CMD_GETONOFF,'Iset':self.CMD_GETSETCURRENT,'Vcut':self.CMD_GETSETCUTOFF}
+    order=['out','Vcut','Iset'] if p.get('out')==0 else ['Vcut','Iset','out'] # off first, on last
+    todo=[x for x in order if x in p and self.cacheget(x)!=p[x]]
+    for t in range(0,self.retriescmd):
+      if todo==[]: return True
+      for x in todo: writes[x](p[x])
+      r=self.px100_query_batch([readback[x] for x in todo])
+      bad=[]
+      for x in todo:
+        v=r.get(readback[x])
+        if v!=None and round(v/self.QUERYFIELDS[readback[x]][1],2)==p[x]:
+          if x=='out': self.out=p[x]
+          continue
+        print(f'ERR: cannot set {x}, desired={p[x]}, actual={v if v==None else v/self.QUERYFIELDS[readback[x]][1]}')
+        self.invalidate(x)
+        bad.append(x)
+      todo=bad
+    if todo!=[]: print('ERR: set failed:',' '.join(todo));return False
+    return True
+
   def setON(self):
     self.setOnOff(1)
 
@@ -654,32 +2034,40 @@ class Instr_Atorch:
     self.setOnOff(0)
 
   def setTOGGLE(self):
+    if self.pending: self.flush()
     if self.cmd_getonoff()==1: self.cmd_setonoff(0)
     else: self.cmd_setonoff(1)
 
 
   def setamp(self,val,rel,verify=True):
-    if rel: val=val+self.cmd_getsetcurrent()
+    if self.pending: self.flush()
+    if rel:
+      cur=self.cmd_getsetcurrent()
+      if cur==None: print('ERR: cannot read current for relative set');return False
+      val=val+cur
     val=round(val,2) # for readback
     if val<0: val=0
     if val>CURRENT_LIMIT: val=CURRENT_LIMIT
+    if self.cacheget('Iset')==val: return True
     for x in range(0,self.retriescmd):
-      self.cmd_setcurrent(val)
-      if not verify: return True
-      res=self.cmd_getsetcurrent()
+      r=self.cmd_setcurrent(val)
+      if not verify: return r
+      res=self.cmd_getsetcurrent(maxage=0)
       if res==val: return True
       print(f'ERR: cannot set current, desired={val}, actual={res}')
     print('ERR: current set failed')
     return False
 
   def setcutoff(self,val,verify=True):
+    if self.pending: self.flush()
     val=round(val,2) # for readback
     if val<0: val=0
     if val>255.2: val=255.2
+    if self.cacheget('Vcut')==val: return True
     for x in range(0,self.retriescmd):
-      self.cmd_setcutoff(val)
-      if not verify: return True
-      res=self.cmd_getsetcutoff()
+      r=self.cmd_setcutoff(val)
+      if not verify: return r
+      res=self.cmd_getsetcutoff(maxage=0)
       if res==val: return True
       print(f'ERR: cannot set cutoff voltage, desired={val}, actual={res}')
     print('ERR: cutoff voltage set failed')
@@ -694,7 +2082,7 @@ class Instr_Atorch:
   statopts=''
   def printstate(self,opts='',help=False):
     if help:
-      print('          opts:  J=JSON, S=short (V/A only), T=show time, U=show UTC time, A=show all, B=force battery, M=minimize queries, L=listen-only');return
+      print('          opts:  J=JSON, S=short (V/A only), T=show time, U=show UTC time, A=show all, B=force battery, M=from status reports and cache, L=listen-only');return
     opts=opts.upper()
     if opts=='': opts=self.statopts
     else: self.statopts=opts
@@ -719,7 +2107,7 @@ class Instr_Atorch:
       from datetime import datetime
       if showtimeutc: timestr=datetime.utcnow().isoformat()[:23]
       else: timestr=datetime.now().isoformat()[:23]
-    a=self.cmd_readstate(energy=energy,limits=limits,temp=temp,timestr=timestr,short=minimize,listenonly=listenonly)
+    a=self.cmd_readstate(energy=energy,limits=limits,temp=temp,timestr=timestr,short=minimize,listenonly=listenonly,cached='M' in opts)
     if json:
       from json import dumps
       print(dumps(a))
@@ -728,6 +2116,1042 @@ class Instr_Atorch:
 
 
 
+#####################
+##
+##  CLOSED-LOOP MODES
+##
+#####################
+
+# constant power (mode P, watts) or constant resistance (mode R, ohms) on top of the CC load:
+# feed-forward current from the measured voltage, plus an integral term on the current error, slew-limited and clamped;
+# the integral stops growing while the output is limited (anti-windup)
+class Regulator:
+  ki=0.5        # integral gain, 1/s
+  slew=5.0      # max. current change, A/s
+  imax=CURRENT_LIMIT
+  intmax=1.0    # integral term limit, A
+  vmin=0.5      # below this voltage the current is set to 0
+  settle=1.0    # seconds after start not counted in the tracking error
+
+  def __init__(self,mode,target,**opts):
+    if mode not in ['P','R']: raise ValueError(f'unknown mode {mode}')
+    if target<=0: raise ValueError('target must be positive')
+    self.mode=mode
+    self.target=target
+    for k,v in opts.items(): setattr(self,k,v)
+    self.imax=min(self.imax,CURRENT_LIMIT)
+    self.integral=0.0
+    self.iset=None
+    self.t=None
+    self.t0=None
+    self.updates=0
+    self.err2=0.0
+    self.errmax=0.0
+    self.errn=0
+
+  # achieved power or resistance for the measurement
+  def achieved(self,v,a):
+    if self.mode=='P': return v*a
+    return v/a if a>0 else float('inf')
+
+  # new current setting for measured voltage and current at time t
+  def update(self,v,a,t):
+    if self.t0==None: self.t0=t
+    dt=0 if self.t==None else t-self.t
+    self.t=t
+    self.updates+=1
+    if self.iset!=None and t-self.t0>=self.settle and a>0:
+      e=(self.achieved(v,a)-self.target)/self.target
+      self.err2+=e*e;self.errmax=max(self.errmax,abs(e));self.errn+=1
+    if v<self.vmin: self.integral=0.0;self.iset=0.0;return 0.0
+    want=self.target/v if self.mode=='P' else v/self.target
+    ierr=want-a if self.iset!=None and self.iset>0 else 0.0
+    i=want+self.integral+self.ki*ierr*dt
+    lo=0.0;hi=self.imax
+    if self.iset!=None and dt>0: lo=max(lo,self.iset-self.slew*dt);hi=min(hi,self.iset+self.slew*dt)
+    limited=i<lo or i>hi
+    if not limited: self.integral=max(-self.intmax,min(self.intmax,self.integral+self.ki*ierr*dt))
+    self.iset=round(max(lo,min(hi,i)),2)
+    return self.iset
+
+  def report(self,elapsed):
+    return {'mode':'C'+self.mode,'target':self.target,'updates':self.updates,'rate':round(self.updates/elapsed,2) if elapsed>0 else 0,
+            'err_rms':round((self.err2/self.errn)**0.5,4) if self.errn else None,'err_max':round(self.errmax,4) if self.errn else None}
+
+  # run on the instrument for secs (0=endless); src 'status' regulates on status packets, 'query' on pipelined V/A queries
+  # prints a line every second, and the summary at the end
+  def run(self,instr,secs=0,src='status',stopoff=False):
+    t0=monotonic();tprint=t0+1;tout=t0+1
+    try:
+      while secs<=0 or monotonic()-t0<secs:
+        if src=='query':
+          r=instr.px100_query_batch([instr.CMD_GETV,instr.CMD_GETA])
+          if instr.CMD_GETV not in r or instr.CMD_GETA not in r: continue
+          v=r[instr.CMD_GETV]/1000;a=r[instr.CMD_GETA]/1000
+        else:
+          instr.recvdata()
+          if not instr.gotupdate(): instr.comm.wait(0.1);continue
+          v=instr.state['V'];a=instr.state['A']
+        now=monotonic()
+        instr.setamp(self.update(v,a,now),False,verify=False)
+        if now>=tout and stopoff:
+          tout=now+1
+          if instr.cmd_getonoff(maxage=0)==0: break
+        if now>=tprint:
+          tprint=now+1
+          print({'V':v,'A':a,'C'+self.mode:round(self.achieved(v,a),3),'Iset':self.iset,'rate':round(self.updates/(now-t0),2)})
+    finally:
+      print(self.report(monotonic()-t0))
+
+
+
+#####################
+##
+##  TEST ENGINES
+##
+#####################
+
+# battery discharge at constant current down to the cutoff voltage; Ah and Wh are integrated on the host from the status packets
+# (trapezoidal, on arrival times), the device counters are only read every check seconds to cross-check and to detect the cutoff
+class DischargeTest:
+  check=60       # seconds between device counter queries
+  maxtime=0      # seconds, 0=until cutoff
+
+  def __init__(self,amps,vcut,**opts):
+    if amps<=0 or amps>CURRENT_LIMIT: raise ValueError('current out of range')
+    if vcut<0: raise ValueError('negative cutoff')
+    self.amps=amps
+    self.vcut=vcut
+    for k,v in opts.items(): setattr(self,k,v)
+    self.ah=0.0
+    self.wh=0.0
+    self.samples=0
+    self.last=None   # (t,V,A)
+
+  def sample(self,t,v,a):
+    if self.last!=None:
+      t0,v0,a0=self.last
+      dt=(t-t0)/3600
+      self.ah+=(a0+a)/2*dt
+      self.wh+=(v0*a0+v*a)/2*dt
+    self.last=(t,v,a)
+    self.samples+=1
+
+  def devcounters(self,instr):
+    r=instr.px100_query_batch([instr.CMD_GETMAH,instr.CMD_GETMWH,instr.CMD_GETONOFF])
+    return r.get(instr.CMD_GETMAH),r.get(instr.CMD_GETMWH),r.get(instr.CMD_GETONOFF)
+
+  # log: file for the per-sample CSV, None for stdout
+  def run(self,instr,log=None):
+    out=stdout if log==None else open(log,'w')
+    instr.setcutoff(self.vcut)
+    instr.setamp(self.amps,False)
+    mah0,mwh0,o=self.devcounters(instr)
+    instr.setON()
+    t0=monotonic();tcheck=t0+self.check
+    cutoff=False;dev=(None,None)
+    print('t,V,A,Ah,Wh',file=out)
+    try:
+      while self.maxtime<=0 or monotonic()-t0<self.maxtime:
+        instr.recvdata()
+        if instr.gotupdate():
+          now=monotonic()
+          v=instr.state['V'];a=instr.state['A']
+          self.sample(now,v,a)
+          print(f'{now-t0:.1f},{v},{a},{self.ah:.4f},{self.wh:.4f}',file=out)
+          if a==0: tcheck=now # no current, check for cutoff at once
+        else: instr.comm.wait(0.5)
+        if monotonic()>=tcheck:
+          tcheck=monotonic()+self.check
+          mah,mwh,o=self.devcounters(instr)
+          if mah!=None and mah0!=None and mwh!=None and mwh0!=None:
+            dev=((mah-mah0)/1000,(mwh-mwh0)/1000)
+            print(f'# check t={monotonic()-t0:.0f} host {self.ah:.4f}Ah {self.wh:.4f}Wh device {dev[0]:.3f}Ah {dev[1]:.3f}Wh',file=out)
+          if o==0: cutoff=True;break
+    finally:
+      if log!=None: out.close()
+      instr.setOFF()
+      r=self.report(monotonic()-t0,cutoff,dev)
+      print(r)
+    return r
+
+  def report(self,elapsed,cutoff,dev):
+    return {'capacity_Ah':round(self.ah,4),'energy_Wh':round(self.wh,4),'mean_V':round(self.wh/self.ah,3) if self.ah>0 else None,
+            'time_s':round(elapsed,1),'cutoff':cutoff,'device_Ah':dev[0],'device_Wh':dev[1],'samples':self.samples}
+
+
+
+# median and the values within k scaled median absolute deviations of it
+def robustfilter(vals,k=3.0):
+  def median(a):
+    a=sorted(a);n=len(a)
+    return a[n//2] if n%2 else (a[n//2-1]+a[n//2])/2
+  med=median(vals)
+  mad=median([abs(x-med) for x in vals])*1.4826
+  if mad==0: return med,[x for x in vals if x==med]
+  return med,[x for x in vals if abs(x-med)<=k*mad]
+
+# DC internal resistance from current steps between two levels: voltage settled before each step against voltage queried
+# right behind the set command, dV/dI from measured values; repeated pulses, outliers rejected around the median
+class IRTest:
+  pulses=5
+  settle=0.5    # seconds at each level before the step
+
+  def __init__(self,ilow,ihigh,**opts):
+    if not 0<=ilow<ihigh<=CURRENT_LIMIT: raise ValueError('need 0 <= low < high current <= limit')
+    self.ilow=ilow
+    self.ihigh=ihigh
+    for k,v in opts.items(): setattr(self,k,v)
+    self.steps=[]
+
+  def step(self,instr,target):
+    q=[instr.CMD_GETV,instr.CMD_GETA]
+    sleep(self.settle)
+    r=instr.px100_query_batch(q)
+    ack,r2,t0=instr.px100_setquery(instr.CMD_SETCURRENT,instr.float2pair(target),q)
+    if ack: instr.cacheset('Iset',target)
+    else: instr.invalidate('Iset')
+    if len(r)<2 or len(r2)<2: print({'step':len(self.steps),'error':'no reply'});return
+    vb=r[q[0]]/1000;ab=r[q[1]]/1000;va=r2[q[0]]/1000;aa=r2[q[1]]/1000
+    if aa==ab: print({'step':len(self.steps),'error':'no current change'});return
+    s={'step':len(self.steps),'I':[ab,aa],'V':[vb,va],'R':round((vb-va)/(aa-ab),5),'delay_ms':round((instr.replytimes[0]-t0)*1000,2)}
+    self.steps.append(s)
+    print(s)
+
+  def run(self,instr):
+    wason=instr.cmd_getonoff(maxage=0)==1
+    instr.setamp(self.ilow,False)
+    instr.setON()
+    try:
+      for p in range(0,self.pulses):
+        self.step(instr,self.ihigh)
+        self.step(instr,self.ilow)
+    finally:
+      instr.setamp(self.ilow,False)
+      if not wason: instr.setOFF()
+      r=self.report()
+      print(r)
+    return r
+
+  def report(self):
+    rs=[x['R'] for x in self.steps]
+    if not rs: return {'R_ohm':None,'steps':0}
+    med,kept=robustfilter(rs)
+    return {'R_ohm':round(sum(kept)/len(kept),5),'median':med,'kept':len(kept),'rejected':len(rs)-len(kept),
+            'delay_ms':round(sum(x['delay_ms'] for x in self.steps)/len(self.steps),2)}
+
+
+
+# I-V sweep: current steps from start to stop, each point set and measured in one write ([SET][QV][QA]), so a point
+# costs one round trip and no read-back of the setting; with dwell the set is verified and the point measured after it
+# the limits are checked on each point before the next one is set: stops at the cutoff voltage, or on foldback
+# (the current falls short of the set value, or the voltage collapses), with the load at the point that tripped
+class SweepTest:
+  dwell=0.0      # seconds at each point before measuring
+  fold=0.9       # foldback when the measured current is below fold*set-0.02 A
+  vmin=0.0       # foldback when the voltage falls below this
+
+  def __init__(self,start,stop,step,**opts):
+    if not (0<=start<=CURRENT_LIMIT and 0<=stop<=CURRENT_LIMIT): raise ValueError(f'currents must be within 0..{CURRENT_LIMIT} A')
+    if step<=0: raise ValueError('step must be positive')
+    for k,v in opts.items(): setattr(self,k,v)
+    n=int(round(abs(stop-start)/step+1e-9))
+    d=step if stop>=start else -step
+    self.points=[round(start+x*d,2) for x in range(0,n+1)]
+    self.rows=[]
+    self.abort=None
+
+  # set a point and measure it; None if the device did not answer
+  def point(self,instr,iset,q):
+    if self.dwell==0:
+      ack,r,t=instr.px100_setquery(instr.CMD_SETCURRENT,instr.float2pair(iset),q)
+      if ack: instr.cacheset('Iset',iset);return r
+      instr.invalidate('Iset')
+    if not instr.setamp(iset,False): self.abort='set failed';return None
+    if self.dwell>0: sleep(self.dwell)
+    return instr.px100_query_batch(q)
+
+  def run(self,instr,out=None):
+    if out==None: out=stdout
+    q=[instr.CMD_GETV,instr.CMD_GETA]
+    vcut=instr.cmd_getsetcutoff()
+    wason=instr.cmd_getonoff(maxage=0)==1
+    iset0=instr.cmd_getsetcurrent()
+    if vcut==None or iset0==None:
+      self.abort='cannot read cutoff and set current'
+      r=self.report(0)
+      print(r)
+      return r
+    instr.setamp(self.points[0],False)
+    instr.setON()
+    print('Iset,V,A,W',file=out)
+    t0=monotonic()
+    try:
+      for iset in self.points:
+        r=self.point(instr,iset,q)
+        if r==None: break
+        if len(r)<2: self.abort='no reply';break
+        v=r[q[0]]/1000;a=r[q[1]]/1000
+        self.rows.append((iset,v,a))
+        print(f'{iset:.2f},{v:.3f},{a:.3f},{v*a:.3f}',file=out)
+        if v<=vcut or v<self.vmin: self.abort=f'voltage {v} V';break
+        if a<self.fold*iset-0.02: self.abort=f'foldback, {a} A of {iset} A';break
+    finally:
+      elapsed=monotonic()-t0
+      instr.setamp(iset0,False)
+      if not wason: instr.setOFF()
+      r=self.report(elapsed)
+      print(r)
+    return r
+
+  def report(self,elapsed):
+    mpp=max(self.rows,key=lambda x:x[1]*x[2],default=None)
+    return {'points':len(self.rows),'of':len(self.points),'time_s':round(elapsed,3),
+            'points_per_s':round(len(self.rows)/elapsed,2) if elapsed>0 else None,'abort':self.abort,
+            'mpp':None if mpp==None else {'V':mpp[1],'A':mpp[2],'W':round(mpp[1]*mpp[2],3)}}
+
+
+
+#####################
+##
+##  ASYNCIO ATORCH API
+##
+#####################
+
+# stand-in for pyserial-asyncio: nonblocking pyserial port read from the event loop via add_reader
+class AsyncSerialTransport:
+  def __init__(self,loop,protocol,portname,baudrate):
+    import serial
+    self.loop=loop
+    self.protocol=protocol
+    self.port=serial.serial_for_url(portname,baudrate,timeout=0)
+    self.fd=self.port.fileno()
+    loop.add_reader(self.fd,self.readready)
+    loop.call_soon(protocol.connection_made,self)
+
+  def readready(self):
+    try: data=self.port.read(self.port.in_waiting or 1)
+    except Exception as e: self.close(e);return
+    if data: self.protocol.data_received(data)
+
+  def write(self,data):
+    self.port.write(data)
+
+  def close(self,exc=None):
+    if self.port==None: return
+    self.loop.remove_reader(self.fd)
+    self.port.close()
+    self.port=None
+    self.protocol.connection_lost(exc)
+
+  def is_closing(self):
+    return self.port==None
+
+
+# asyncio client; is its own asyncio protocol, replies resolve waiting futures as soon as the framer completes them
+# usage: a=AsyncAtorch(); await a.open_tcp(host); v=await a.getvolt(); await a.setamp(1.5)
+class AsyncAtorch(Instr_Atorch):
+  onstatus=None       # callback(self) on every status packet
+  onlost=None         # callback(self,exc) when the connection is gone
+
+  def __init__(self):
+    super().__init__()
+    self.transport=None
+    self.waiters=[]     # [kind,future] in send order
+    self.late={}        # kind: [until], one entry per timed out request whose reply may still come
+    self.statuswaiters=[]
+    self.lock=None
+    self.last_rtt=None
+
+  async def open_tcp(self,host,port=DEFAULT_TCPPORT):
+    import asyncio
+    loop=asyncio.get_running_loop()
+    await loop.create_connection(lambda: self,host,port)
+    return self
+
+  async def open_serial(self,portname=DEFAULT_SERPORT,baudrate=DEFAULT_BAUDRATE):
+    import asyncio
+    AsyncSerialTransport(asyncio.get_running_loop(),self,portname,baudrate)
+    await asyncio.sleep(0) # let connection_made run
+    return self
+
+  def close(self):
+    if self.transport!=None: self.transport.close()
+
+  # asyncio protocol interface
+  def connection_made(self,transport):
+    import asyncio
+    self.transport=transport
+    self.lock=asyncio.Lock()
+    try:
+      sock=transport.get_extra_info('socket')
+      if sock!=None: sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+    except AttributeError: pass # serial stand-in
+
+  def connection_lost(self,exc):
+    self.transport=None
+    for w in self.waiters+self.statuswaiters:
+      if not w[1].done(): w[1].set_exception(ConnectionError('connection lost'))
+    self.waiters=[];self.statuswaiters=[]
+    self.late={}
+    self.framer.clear()
+    if self.onlost!=None: self.onlost(self,exc)
+
+  def data_received(self,data):
+    self.showpacket(data,name='RECV:',force=self.verbcomsr)
+    self.framer.feed(data)
+    while True:
+      f=self.framer.next()
+      if f==None: break
+      kind,p=f
+      if kind==FRAME_STATUS:
+        self.handlelongpacket(p)
+        if self.onstatus!=None: self.onstatus(self)
+        for w in self.statuswaiters:
+          if not w[1].done(): w[1].set_result(dict(self.state))
+        self.statuswaiters=[]
+        continue
+      # replies carry no request id: a reply may be the late answer to a timed out request, and would be taken
+      # for the next one of the kind; as many replies as there were timeouts within a timeout after each are dropped
+      late=[x for x in self.late.get(kind,[]) if x>monotonic()]
+      if late:
+        self.late[kind]=late[1:]
+        continue
+      self.late.pop(kind,None)
+      for w in self.waiters:
+        if w[0]==kind and not w[1].done():
+          w[1].set_result(bytes(p))
+          self.waiters.remove(w)
+          break
+      # unmatched replies, not expected by anyone, are dropped
+
+  def eof_received(self):
+    return False
+
+  # send packet, wait for the reply kind; per-try timeout, retried; cancellable
+  async def transact(self,packet,kind,timeout=None,retries=None):
+    import asyncio
+    if retries==None: retries=self.retries
+    if self.transport==None: raise ConnectionError('not connected')
+    async with self.lock:
+      for t in range(0,retries):
+        if kind==FRAME_ACK: self.framer.expectshort=True
+        elif kind==FRAME_PX100: self.framer.expectans=True
+        w=[kind,asyncio.get_running_loop().create_future()]
+        self.waiters.append(w)
+        self.showpacket(packet,name='SEND:',force=self.verbcomsr)
+        t0=monotonic()
+        self.transport.write(packet)
+        try:
+          r=await asyncio.wait_for(w[1],timeout if timeout!=None else self.rtt.rto)
+          self.last_rtt=monotonic()-t0
+          if t==0: self.rtt.sample(self.last_rtt)
+          return r
+        except asyncio.TimeoutError:
+          self.late.setdefault(kind,[]).append(monotonic()+self.rtt.rto)
+          self.rtt.timedout()
+          print('REPLY TIMEOUT',file=stdlog)
+        finally:
+          if w in self.waiters: self.waiters.remove(w)
+    return None
+
+  async def px100_command(self,cmd,d=[0,0],timeout=None):
+    r=await self.transact(pack('>BBBBBB',0xb1,0xb2,cmd,d[0],d[1],0xb6),FRAME_ACK,timeout=timeout)
+    if r==None: print('ERR: cannot send command!',file=stdlog)
+    return r!=None
+
+  async def px100_query(self,cmd,id='',div=1,timeout=None):
+    r=await self.transact(pack('>BBBBBB',0xb1,0xb2,cmd,0,0,0xb6),FRAME_PX100,timeout=timeout)
+    if r==None:
+      print(f'ERR: no PX100 response ({id})',file=stdlog)
+      return None
+    val=getint24(r,2)
+    if div!=1: return val/div
+    return val
+
+  async def atorch_command(self,cmd,d=[0,0,0,0],timeout=None):
+    packet=pack('>BBBBBBBBB',0xff,0x55,0x11,self.ADU,cmd,d[0],d[1],d[2],d[3])
+    packet+=pack('>B',self.atorch_get_crc(packet[2:]))
+    return await self.transact(packet,FRAME_REPLY,timeout=timeout)!=None
+
+  # wait for the next status packet, returns copy of the decoded state
+  async def waitstatus(self,timeout=None):
+    import asyncio
+    w=[FRAME_STATUS,asyncio.get_running_loop().create_future()]
+    self.statuswaiters.append(w)
+    try: return await asyncio.wait_for(w[1],timeout)
+    finally:
+      if w in self.statuswaiters: self.statuswaiters.remove(w)
+
+  async def getonoff(self):    self.out=await self.px100_query(self.CMD_GETONOFF,id='onoff');return self.out
+  async def getvolt(self,div=1000): return await self.px100_query(self.CMD_GETV,id='V',div=div)
+  async def getamp(self,div=1000):  return await self.px100_query(self.CMD_GETA,id='A',div=div)
+  async def getah(self,div=1000):   return await self.px100_query(self.CMD_GETMAH,id='Ah',div=div)
+  async def getwh(self,div=1000):   return await self.px100_query(self.CMD_GETMWH,id='Wh',div=div)
+  async def gettemp(self):          return await self.px100_query(self.CMD_GETTEMP,id='temp')
+  async def getsetcurrent(self):    return await self.px100_query(self.CMD_GETSETCURRENT,id='setcurrent',div=100)
+  async def getsetcutoff(self):     return await self.px100_query(self.CMD_GETSETCUTOFF,id='setcutoff',div=100)
+  async def resetcounters(self):    return await self.px100_command(self.CMD_RESET)
+  async def button(self,butt):      return await self.atorch_command(butt)
+
+  async def setonoff(self,val,verify=True):
+    if val!=0 and val!=1: val=0
+    for x in range(0,self.retriescmd):
+      await self.px100_command(self.CMD_ONOFF,[val,0])
+      if not verify: return True
+      res=await self.getonoff()
+      if res==val: return True
+      print(f'ERR: cannot set output, desired={val}, actual={res}',file=stdlog)
+    return False
+
+  async def setamp(self,val,rel=False,verify=True):
+    if rel:
+      cur=await self.getsetcurrent()
+      if cur==None: return False
+      val+=cur
+    val=min(max(round(val,2),0),CURRENT_LIMIT)
+    for x in range(0,self.retriescmd):
+      await self.px100_command(self.CMD_SETCURRENT,self.float2pair(val))
+      if not verify: return True
+      res=await self.getsetcurrent()
+      if res==val: return True
+      print(f'ERR: cannot set current, desired={val}, actual={res}',file=stdlog)
+    return False
+
+  async def setcutoff(self,val,verify=True):
+    val=min(max(round(val,2),0),255.2)
+    for x in range(0,self.retriescmd):
+      await self.px100_command(self.CMD_SETCUTOFF,self.float2pair(val))
+      if not verify: return True
+      res=await self.getsetcutoff()
+      if res==val: return True
+      print(f'ERR: cannot set cutoff voltage, desired={val}, actual={res}',file=stdlog)
+    return False
+
+  async def readstate(self,energy=True,limits=True,temp=True,short=False):
+    a={'out':await self.getonoff()}
+    a.update(self.state)
+    a['V']=await self.getvolt()
+    if short: return a
+    a['A']=await self.getamp()
+    if energy: a['Ah']=await self.getah();a['Wh']=await self.getwh()
+    if limits: a['Iset']=await self.getsetcurrent();a['Vcut']=await self.getsetcutoff()
+    if temp: a['temp']=await self.gettemp()
+    return a
+
+
+
+##########################
+##
+##  FLEET OF DEVICES
+##
+##########################
+
+# many loads driven from one process and one asyncio event loop; each device has its own command queue and worker,
+# commands come from stdin as "<target> <command> [command]...", target is device id, group name or * for all
+class Fleet:
+  verb=False
+  backoffmin=0.5      # reconnect delay, doubled after each failure up to backoffmax, randomized by half
+  backoffmax=30
+
+  def __init__(self,opts=''):
+    self.devs={}      # id: AsyncAtorch
+    self.specs={}     # id: connection spec
+    self.groups={}    # name: [ids]
+    self.queues={}
+    self.reconnecting={} # id: task
+    self.closing=False
+    self.json='J' in opts
+    self.listen='L' in opts
+
+  # spec: tcp:host[:port] or serport[@baud]
+  def adddev(self,id,spec):
+    self.specs[id]=spec
+    self.devs[id]=AsyncAtorch()
+    self.devs[id].devid=id
+
+  def addgroup(self,name,ids):
+    self.groups[name]=ids
+
+  def out(self,id,*a):
+    print(f'[{id}]',*a,flush=True)
+
+  def targets(self,t):
+    if t in ['*','ALL']: return list(self.devs)
+    if t in self.groups: return self.groups[t]
+    if t in self.devs: return [t]
+    return None
+
+  def printstatus(self,dev):
+    if not self.listen: return
+    if self.json:
+      from json import dumps
+      self.out(dev.devid,dumps(dev.state))
+    else: self.out(dev.devid,dev.state)
+
+  async def connect(self,id):
+    dev=self.devs[id];spec=self.specs[id]
+    try:
+      if spec[:4].lower()=='tcp:':
+        a=(spec[4:]+':'+str(DEFAULT_TCPPORT)).split(':')
+        await dev.open_tcp(a[0],int(a[1]))
+      else:
+        a=(spec+'@'+str(DEFAULT_BAUDRATE)).split('@')
+        await dev.open_serial(a[0],int(a[1]))
+    except Exception as e:
+      self.out(id,'ERRCONN:',e)
+      return False
+    dev.onstatus=self.printstatus
+    dev.onlost=self.lost
+    if self.verb: self.out(id,'connected',spec)
+    return True
+
+  # connection gone: report the device offline, its commands fail until reconnected in background
+  def lost(self,dev,exc):
+    if self.closing: return
+    self.out(dev.devid,'OFFLINE:',exc if exc!=None else 'connection closed')
+    self.startreconnect(dev.devid)
+
+  def startreconnect(self,id):
+    import asyncio
+    if id not in self.reconnecting: self.reconnecting[id]=asyncio.get_running_loop().create_task(self.reconnect(id))
+
+  async def reconnect(self,id):
+    import asyncio
+    from random import random
+    failures=0
+    try:
+      while not self.closing:
+        d=min(self.backoffmax,self.backoffmin*2**failures)
+        await asyncio.sleep(d/2+random()*d/2)
+        failures+=1
+        if await self.connect(id):
+          self.out(id,'ONLINE')
+          return
+    finally: self.reconnecting.pop(id,None)
+
+  # execute one command on one device
+  async def command(self,id,cmd):
+    import asyncio
+    dev=self.devs[id]
+    if dev.transport==None: self.out(id,'ERR: offline');return
+    cmdarr=(cmd+':::').split(':')
+    c=cmdarr[0].upper()
+    q={'QV':(dev.getvolt,()),'QMV':(dev.getvolt,(1,)),'QA':(dev.getamp,()),'QMA':(dev.getamp,(1,)),
+       'QAH':(dev.getah,()),'QMAH':(dev.getah,(1,)),'QWH':(dev.getwh,()),'QMWH':(dev.getwh,(1,)),
+       'QTI':(dev.gettemp,()),'QVCUT':(dev.getsetcutoff,()),'QOUT':(dev.getonoff,()),'QISET':(dev.getsetcurrent,())}
+    if c in q: self.out(id,c,await q[c][0](*q[c][1]))
+    elif c=='ON': await dev.setonoff(1)
+    elif c=='OFF': await dev.setonoff(0)
+    elif c=='RESET': await dev.resetcounters()
+    elif c in ['STATE','STAT','STATUS','JSTATE','STATEJ']:
+      o=cmdarr[1].upper()
+      a=await dev.readstate(short='S' in o)
+      if self.json or c[0]=='J' or c[-1]=='J' or 'J' in o:
+        from json import dumps
+        self.out(id,dumps(a))
+      else: self.out(id,a)
+    elif c[:5]=='SLEEP':
+      try: await asyncio.sleep(float(c[5:]+cmdarr[1] or 1))
+      except ValueError: self.out(id,'[Unknown delay:',cmd,']')
+    elif c[-4:]=='VCUT':
+      try: await dev.setcutoff(float(c[:-4]))
+      except ValueError: self.out(id,'[Unknown voltage to set:',cmd,']')
+    elif c[-2:]=='MA' or c[-1:]=='A':
+      try:
+        v=c[:-2] if c[-2:]=='MA' else c[:-1]
+        val=float(v)/(1000 if c[-2:]=='MA' else 1)
+        await dev.setamp(val,rel=v[0] in '+-')
+      except (ValueError,IndexError): self.out(id,'[Unknown current to set:',cmd,']')
+    else: self.out(id,'[Unknown command:',cmd,']')
+
+  async def worker(self,id):
+    q=self.queues[id]
+    while True:
+      cmd=await q.get()
+      try:
+        if cmd!=None: await self.command(id,cmd)
+      except Exception as e: self.out(id,'ERR:',e)
+      q.task_done()
+      if cmd==None: return
+
+  def dispatch(self,line):
+    a=line.split()
+    if len(a)<2: print('ERR: expected "<target> <command>..."',file=stderr);return
+    ids=self.targets(a[0])
+    if ids==None: print('ERR: unknown device or group:',a[0],file=stderr);return
+    for id in ids:
+      for c in a[1:]: self.queues[id].put_nowait(c)
+
+  async def main(self,infd):
+    import asyncio,os
+    loop=asyncio.get_running_loop()
+    ok=await asyncio.gather(*[self.connect(x) for x in self.devs])
+    if not any(ok): print('ERR: no device connected',file=stderr);return
+    for x,o in zip(self.devs,ok):
+      if not o: self.startreconnect(x)
+    self.queues={x:asyncio.Queue() for x in self.devs}
+    workers=[asyncio.create_task(self.worker(x)) for x in self.devs]
+    eof=loop.create_future()
+    buf=[b'']
+    def readin(): # raw fd reads, a buffered readline could keep lines that select won't report
+      d=os.read(infd,4096)
+      if d==b'':
+        loop.remove_reader(infd)
+        if not eof.done(): eof.set_result(True)
+        return
+      buf[0]+=d
+      *lines,buf[0]=buf[0].split(b'\n')
+      for l in lines:
+        l=l.decode(errors='replace').strip()
+        if l!='' and l[0]!='#': self.dispatch(l)
+    loop.add_reader(infd,readin)
+    await eof
+    for x in self.devs: self.queues[x].put_nowait(None)
+    await asyncio.gather(*workers)
+    self.closing=True
+    for t in list(self.reconnecting.values()): t.cancel()
+    for x in self.devs: self.devs[x].close()
+
+  def run(self,infd=None):
+    import asyncio
+    if infd==None: infd=stdin.fileno()
+    try: asyncio.run(self.main(infd))
+    except KeyboardInterrupt: pass
+
+
+
+####################
+##
+##  EVENT LOOP
+##
+####################
+
+# minimal selector loop: readable and writable file objects with callbacks, and one-shot timers
+class EventLoop:
+  def __init__(self):
+    import selectors
+    self.EVENT_READ=selectors.EVENT_READ
+    self.EVENT_WRITE=selectors.EVENT_WRITE
+    self.sel=selectors.DefaultSelector()
+    self.timers=[]    # heap of [when,seq,callback]
+    self.seq=0
+    self.running=False
+
+  # callbacks of a file object: [on readable, on writable], None for unused
+  def setcallback(self,f,n,callback):
+    try: key=self.sel.get_key(f)
+    except (KeyError,ValueError): key=None
+    cb=[None,None] if key==None else list(key.data)
+    cb[n]=callback
+    ev=(self.EVENT_READ if cb[0]!=None else 0)|(self.EVENT_WRITE if cb[1]!=None else 0)
+    if ev==0:
+      if key!=None: self.sel.unregister(f)
+    elif key!=None: self.sel.modify(f,ev,cb)
+    else: self.sel.register(f,ev,cb)
+
+  def addreader(self,f,callback):
+    self.setcallback(f,0,callback)
+
+  def delreader(self,f):
+    self.setcallback(f,0,None)
+
+  def addwriter(self,f,callback):
+    self.setcallback(f,1,callback)
+
+  def delwriter(self,f):
+    self.setcallback(f,1,None)
+
+  def calllater(self,delay,callback):
+    from heapq import heappush
+    self.seq+=1
+    t=[monotonic()+delay,self.seq,callback]
+    heappush(self.timers,t)
+    return t
+
+  def cancel(self,t):
+    t[2]=None
+
+  # (re)register a port; a reconnected TCP port has a new socket, maybe under the number of the old one
+  # key: what the last call returned
+  def watchport(self,comm,callback,key=None):
+    new=(comm.fileno(),getattr(comm,'generation',0))
+    if new==key: return key
+    if key!=None and key[0]!=None: self.delreader(key[0])
+    if new[0]!=None: self.addreader(new[0],callback)
+    return new
+
+  # how long to wait for a port: until its own next deadline (simulated byte, reconnect), for ever on a file descriptor
+  def porttimeout(self,comm):
+    t=comm.nextevent() if hasattr(comm,'nextevent') else None
+    if t!=None: return max(0,t-monotonic())
+    return None if comm.fileno()!=None else 0.05
+
+  # wait for events up to timeout (None=until the next timer) and dispatch them
+  def runonce(self,timeout=None):
+    from heapq import heappop
+    while self.timers and self.timers[0][2]==None: heappop(self.timers)
+    if self.timers:
+      t=max(0,self.timers[0][0]-monotonic())
+      if timeout==None or t<timeout: timeout=t
+    for key,mask in self.sel.select(timeout):
+      if mask&self.EVENT_READ and key.data[0]!=None: key.data[0]()
+      if mask&self.EVENT_WRITE and key.data[1]!=None:
+        try: cb=self.sel.get_key(key.fileobj).data[1] # the read callback may have closed it
+        except (KeyError,ValueError): cb=None
+        if cb!=None: cb()
+    now=monotonic()
+    while self.timers and self.timers[0][0]<=now:
+      t=heappop(self.timers)
+      if t[2]!=None: t[2]()
+
+  def run(self):
+    self.running=True
+    while self.running: self.runonce()
+
+  def stop(self):
+    self.running=False
+
+  # the selector holds a file descriptor (epoll), and the callbacks may refer back to the owner
+  def close(self):
+    self.timers=[]
+    self.sel.close()
+
+
+# line-oriented stream server on an event loop; online(conn,line) is called for every received line
+# sockets stay nonblocking, output is buffered per connection and written when the socket takes it
+class LineServer:
+  maxout=1<<20      # bytes of unsent output; a client not reading that much is dropped
+
+  def __init__(self,loop,lsock,online,onclose=None):
+    self.loop=loop
+    self.lsock=lsock
+    self.online=online
+    self.onclose=onclose
+    self.conns={}     # conn: received partial line
+    self.out={}       # conn: unsent output
+    self.closing=set() # conns to close once their output is sent
+    lsock.setblocking(False)
+    loop.addreader(lsock,self.accept)
+
+  def accept(self):
+    try: c,a=self.lsock.accept()
+    except BlockingIOError: return
+    c.setblocking(False)
+    self.conns[c]=b''
+    self.out[c]=bytearray()
+    self.loop.addreader(c,lambda: self.read(c))
+
+  def read(self,c):
+    try: d=c.recv(4096)
+    except (BlockingIOError,InterruptedError): return
+    except OSError: d=b''
+    if d==b'': self.close(c);return
+    self.conns[c]+=d
+    *lines,self.conns[c]=self.conns[c].split(b'\n')
+    for l in lines:
+      if c not in self.conns: break
+      self.online(c,l.decode(errors='replace').strip())
+
+  def send(self,c,s):
+    if c not in self.conns: return
+    if isinstance(s,str): s=s.encode()
+    self.out[c]+=s
+    if len(self.out[c])>self.maxout: self.close(c);return
+    self.flush(c)
+
+  # write what the socket takes now, the rest when it gets writable
+  def flush(self,c):
+    if c not in self.conns: return
+    b=self.out[c]
+    try: n=c.send(b) if b else 0
+    except (BlockingIOError,InterruptedError): n=0
+    except OSError: self.close(c);return
+    del b[:n]
+    if b: self.loop.addwriter(c,lambda: self.flush(c))
+    else:
+      self.loop.delwriter(c)
+      if c in self.closing: self.close(c)
+
+  # stop reading and close once the output is sent
+  def finish(self,c):
+    if c not in self.conns: return
+    self.loop.delreader(c)
+    self.closing.add(c)
+    self.flush(c)
+
+  def close(self,c):
+    if c not in self.conns: return
+    self.loop.delreader(c)
+    self.loop.delwriter(c)
+    del self.conns[c]
+    del self.out[c]
+    self.closing.discard(c)
+    if self.onclose!=None: self.onclose(c)
+    c.close()
+
+  def shutdown(self):
+    for c in list(self.conns): self.close(c)
+    self.loop.delreader(self.lsock)
+    self.lsock.close()
+
+
+
+####################
+##
+##  SCPI GATEWAY
+##
+####################
+
+DEFAULT_SCPIPORT=5025
+
+# SCPI subset over raw TCP mapped onto Instr_Atorch; many clients, requests arriving together are handled as one batch,
+# each client's commands in order (see steps()), queries served from fresh cache/status packet values where possible,
+# the rest read from the device once per distinct value, in one pipelined burst
+class ScpiGateway:
+  IDN='ATORCH,DL24,0,dl24.py'
+  # long forms to short forms; SOURce and the DC suffix are optional
+  SHORT={'MEASURE':'MEAS','VOLTAGE':'VOLT','CURRENT':'CURR','POWER':'POW','TEMPERATURE':'TEMP','INPUT':'INP',
+         'OUTPUT':'OUTP','STATE':'STAT','CUTOFF':'CUT','SYSTEM':'SYST','ERROR':'ERR','SOURCE':'SOUR','FETCH':'FETC','RESISTANCE':'RES'}
+  QUERIES={'MEAS:VOLT?':'V','MEAS:CURR?':'A','MEAS:POW?':'W','MEAS:TEMP?':'temp','MEAS:RES?':'R',
+           'CURR?':'Iset','VOLT:CUT?':'Vcut','INP?':'out','INP:STAT?':'out','OUTP?':'out','OUTP:STAT?':'out'}
+  WRITES={'CURR':'Iset','VOLT:CUT':'Vcut','INP':'out','INP:STAT':'out','OUTP':'out','OUTP:STAT':'out'}
+
+  def __init__(self,instr,loop,lsock):
+    self.instr=instr
+    self.loop=loop
+    self.pending=[]   # (conn,line)
+    self.errors={}    # conn: [errors]
+    self.srv=LineServer(loop,lsock,self.online,onclose=lambda c: self.errors.pop(c,None))
+    self.transactions=0
+    self.coalesced=0
+
+  def online(self,c,line):
+    if line!='': self.pending.append((c,line))
+
+  def norm(self,header):
+    a=[]
+    for x in header.upper().lstrip(':').split(':'):
+      q=x[-1:]=='?'
+      if q: x=x[:-1]
+      x=self.SHORT.get(x,x)
+      if q: x+='?'
+      a.append(x)
+    if a[0] in ['SOUR','SOUR?']: a=a[1:] or ['?']
+    if len(a)>1 and a[-1] in ['DC','DC?']:
+      q=a.pop()[-1:]=='?'
+      if q and a[-1][-1:]!='?': a[-1]+='?'
+    return ':'.join(a)
+
+  def error(self,c,code,msg):
+    self.errors.setdefault(c,[]).append(f'{code},"{msg}"')
+
+  # parse a line into [(kind,header,arg)], kind: Q=device query, W=write, C=constant answer,
+  # E=error queue access, X=undefined header; errors are queued and read in order when processed
+  def parse(self,line):
+    ops=[]
+    for x in line.split(';'):
+      x=x.strip()
+      if x=='': continue
+      a=x.split(None,1)
+      h=self.norm(a[0]);arg=a[1].strip() if len(a)>1 else None
+      if h=='*IDN?': ops.append(('C',h,self.IDN))
+      elif h=='*RST': ops.append(('W','INP','OFF'))
+      elif h=='*OPC?': ops.append(('C',h,'1'))
+      elif h in ['*CLS','SYST:ERR?']: ops.append(('E',h,None))
+      elif h in self.QUERIES: ops.append(('Q',h,None))
+      elif h in self.WRITES and arg!=None: ops.append(('W',h,arg))
+      else: ops.append(('X',a[0],None))
+    return ops
+
+  def write(self,c,h,arg):
+    f=self.WRITES[h]
+    try:
+      if f=='out':
+        v={'ON':1,'1':1,'OFF':0,'0':0}.get(arg.upper())
+        if v==None: raise ValueError
+        ok=self.instr.setOnOff(v)
+      elif f=='Iset': ok=self.instr.setamp(float(arg),rel=False)
+      else: ok=self.instr.setcutoff(float(arg))
+      if not ok: self.error(c,-300,'Device error')
+      self.transactions+=1
+    except ValueError: self.error(c,-224,'Illegal parameter value')
+
+  # value for query field from cache or the batch result
+  def value(self,f,r):
+    if f=='W':
+      v=self.value('V',r);a=self.value('A',r)
+      return None if v==None or a==None else round(v*a,3)
+    if f=='R':
+      v=self.value('V',r);a=self.value('A',r)
+      return None if v==None or a==None or a==0 else round(v/a,3)
+    return self.instr.cacheget(f)
+
+  # the lines of a client are done in steps: writes, then the queries up to the next write; step n of all
+  # clients runs together, so their queries share one batch while every client sees its own order
+  # ops: (kind,header,arg,line number)
+  def steps(self,ops):
+    st=[[]]
+    for op in ops:
+      if op[0]=='W' and any(x[0]!='W' for x in st[-1]): st.append([])
+      st[-1].append(op)
+    return st
+
+  def process(self):
+    jobs=self.pending;self.pending=[]
+    ops={}
+    for j,(c,l) in enumerate(jobs): ops.setdefault(c,[]).extend(x+(j,) for x in self.parse(l))
+    parsed=[(c,self.steps(x)) for c,x in ops.items()]
+    ans=[[] for x in jobs]
+    for n in range(0,max(len(st) for c,st in parsed)):
+      step=[(c,st[n]) for c,st in parsed if n<len(st)]
+      wrote=False
+      for c,ops in step:
+        for kind,h,arg,j in ops:
+          if kind=='W': self.write(c,h,arg);wrote=True
+      if wrote: self.instr.invalidate('V','A','out') # measured before the write
+      # distinct values needed, not fresh in cache
+      need={};asked=0
+      for c,ops in step:
+        for kind,h,arg,j in ops:
+          if kind!='Q': continue
+          f=self.QUERIES[h];asked+=1
+          for x in (['V','A'] if f in ['W','R'] else [f]):
+            if self.instr.cacheget(x)==None: need[x]=True
+      if need:
+        cmds=[k for k,v in self.instr.QUERYFIELDS.items() if v[0] in need]
+        self.instr.px100_query_batch(cmds) # results land in the cache
+        self.transactions+=len(cmds)
+      self.coalesced+=max(0,asked-len(need))
+      for c,ops in step:
+        for kind,h,arg,j in ops:
+          if kind=='C': ans[j].append(arg)
+          elif kind=='X': self.error(c,-113,'Undefined header '+h)
+          elif kind=='E':
+            e=self.errors.setdefault(c,[])
+            if h=='*CLS': e.clear()
+            else: ans[j].append(e.pop(0) if e else '0,"No error"')
+          elif kind=='Q':
+            v=self.value(self.QUERIES[h],None)
+            if v==None: self.error(c,-300,'Device error');v='9.91E37' # SCPI NaN
+            ans[j].append(str(v))
+    for (c,l),a in zip(jobs,ans):
+      if a: self.srv.send(c,';'.join(a)+'\n')
+
+  def run(self):
+    key=None
+    try:
+      while True:
+        key=self.loop.watchport(self.instr.comm,self.instr.recvdata,key)
+        self.loop.runonce(self.loop.porttimeout(self.instr.comm))
+        self.instr.recvdata()
+        if self.pending: self.process()
+    finally:
+      self.srv.shutdown()
+      self.loop.close()
+
+
+
 ###############################
 ##
 ##  HIGH LEVEL COMMAND HANDLING
@@ -748,16 +3172,63 @@ class PowerLoad:
 
   def __init__(self):
     self.instr=Instr_Atorch()
+    self.stdinops={}   # line: op, the ops are bound to this instance
 
   strin=''
 
-  # console input with timeout, returns '' when timeout, False when stdin closed
-  def timeout_stdin(self,timeout=0.1, default=""):
-    inputs, outputs, errors = select([stdin], [], [], timeout)
-    if not inputs: return ''
-    s=stdin.readline()
-    if len(s)==0: return False # stdin closed
-    return s.strip()
+  stdinbuf=b''       # stdin read but not yet handled, kept between waitevents() calls
+  stdineof=False
+
+  # one event loop on stdin, the device and a deadline: sleeps in the kernel until one of them is due, then dispatches
+  # online(line) for stdin lines (None at end of input), onupdate() after status reports, until: monotonic deadline
+  # a callback returning True ends it
+  def waitevents(self,online=None,onupdate=None,until=None):
+    import os
+    loop=EventLoop()
+    instr=self.instr;comm=instr.comm
+    infd=stdin.fileno() if online!=None and not self.stdineof else None
+    def lines():
+      while b'\n' in self.stdinbuf and loop.running:
+        l,self.stdinbuf=self.stdinbuf.split(b'\n',1)
+        l=l.decode(errors='replace').strip()
+        if l!='' and online(l): loop.stop()
+      if self.stdineof and loop.running and online(None): loop.stop()
+    def readin(): # raw fd reads, a buffered readline could keep lines that select won't report
+      d=os.read(infd,4096)
+      if d==b'':
+        loop.delreader(infd)
+        self.stdineof=True
+        if self.stdinbuf!=b'': self.stdinbuf+=b'\n'
+      self.stdinbuf+=d
+      lines()
+    def device():
+      while instr.recvdata(): pass
+      if onupdate!=None and instr.gotupdate() and onupdate(): loop.stop()
+    try:
+      key=loop.watchport(comm,device)
+      direct=False # stdin the selector refuses (regular file, /dev/null under epoll) is always readable: read it in the loop
+      if infd!=None:
+        try: loop.addreader(infd,readin)
+        except OSError: direct=True
+      loop.running=True
+      if online!=None: lines() # left from the last time
+      while loop.running:
+        now=monotonic()
+        t=[]
+        if direct and not self.stdineof:
+          readin()
+          if not loop.running: break
+          t.append(0)
+        if until!=None:
+          if now>=until: break
+          t.append(until-now)
+        pt=loop.porttimeout(comm)
+        if pt!=None: t.append(pt)
+        if instr.pending: t.append(max(0,instr.pendingdeadline-now))
+        loop.runonce(min(t) if t else None)
+        if loop.running: device()
+        key=loop.watchport(comm,device,key)
+    finally: loop.close()
 
 
   # return float and if it is absolute or relative
@@ -791,6 +3262,19 @@ class PowerLoad:
     elif cmd=='CFGFILE':
       if help: print('  CFGFILE        generate config file template to stdout');return False
       self.makecfgfile()
+    elif cmd=='DECODE':
+      if help: print('  DECODE:file[:adu]  decode status packets from a raw capture file to CSV');return False
+      a=(cmdorig[7:]+':').split(':')
+      try: adu=None if a[1]=='' else int(a[1])
+      except: print('[Unknown ADU:',cmdorig,']');return False
+      if adu!=None and adu not in STATUS_LAYOUTS: print('[Unknown ADU:',cmdorig,']');return False
+      self.decodefile(a[0],adu=adu)
+    elif cmd=='PLAY':
+      if help: print('  PLAY:file[:from[:to]]  print records of a REC capture in time range (epoch secs or YYYYMMDDTHHMMSS)');return False
+      a=(cmdorig[5:]+'::').split(':')
+      try: t0=self.parsetime(a[1]);t1=self.parsetime(a[2])
+      except ValueError: print('[Unknown time:',cmdorig,']');return False
+      self.playfile(a[0],t0,t1)
     elif cmd=='-':
       if help or not dryrun: print();return True
 
@@ -800,16 +3284,29 @@ class PowerLoad:
         a=(cmdorig[4:]+':'+str(DEFAULT_TCPPORT)).split(':')
         self.conf['host']=a[0]
         self.conf['port']=int(a[1])
-        for x in ['serport','baudrate']:
+        for x in ['serport','baudrate','sim']:
           if x in self.conf: self.conf.pop(x)
 
+    elif cmd[:4]=='SIM=':
+      if help: print('  SIM=[opts]                simulated device; opts: adu=,model=bat:V:V:Ah:ohm|psu:V:ohm,lat=,baud=,loss=,corrupt=,replay=,seed=');return False
+      if dryrun:
+        self.conf['sim']=cmdorig[4:]
+        for x in ['serport','baudrate','host','port']:
+          if x in self.conf: self.conf.pop(x)
+
+    elif cmd[:4]=='DEV=':
+      if help: print('  DEV=id=tcp:addr[:port]    add fleet device, or DEV=id=/dev/ttyport[@baud]');return False
+      a=(cmdorig[4:]+'=').split('=')
+      if a[0]=='' or a[1]=='': print('[Bad device definition:',cmdorig,']');return False
+      if dryrun: self.conf['dev.'+a[0]]=a[1]
+
     elif cmd[:5]=='PORT=':
       if help: print('  PORT=/dev/ttyport[@baud]  set connection via serial port');return False
       if dryrun:
         a=(cmdorig[5:]+'@'+str(DEFAULT_BAUDRATE)).split('@')
         self.conf['serport']=DEFAULT_SERPORT if a[0]=='' else a[0]
         self.conf['baudrate']=a[1]
-        for x in ['host','port']:
+        for x in ['host','port','sim']:
           if x in self.conf: self.conf.pop(x)
 
 
@@ -863,13 +3360,19 @@ class PowerLoad:
     # output switch control
     elif cmd=='ON':
       if help: print('  ON             enable output');return False
-      if not dryrun: self.instr.setON()
+      if not dryrun: self.instr.queueset('out',1)
     elif cmd=='OFF':
       if help: print('  OFF            disable output');return False
-      if not dryrun: self.instr.setOFF()
+      if not dryrun: self.instr.queueset('out',0)
     elif cmd=='TOGGLE':
       if help: print('  TOGGLE         toggle output');return False
       if not dryrun: self.instr.setTOGGLE()
+    elif cmd=='FLUSH':
+      if help: print('  FLUSH          write and verify the queued settings now');return False
+      if not dryrun: self.instr.flush()
+    elif cmd=='NOQUEUE':
+      if help: print('  NOQUEUE        write settings at once, do not queue them until FLUSH, a query or 0.2 s');return False
+      self.instr.writequeue=False
 
 
     # volt/amp settings
@@ -878,18 +3381,106 @@ class PowerLoad:
       try: val,rel=self.floatrel(cmd[:-4])
       except: print('[Unknown voltage to set:',cmd,']',file=stderr);return False
       if rel: print('[No relative value for voltage cutoff!]');return False
-      if not dryrun: self.instr.setcutoff(val)
+      if not dryrun: self.instr.queueset('Vcut',val)
     elif cmd[-2:]=='MA':
       if help: print('  nn.nnMA        set output current');return False
       try: val,rel=self.floatrel(cmd[:-2])
       except: print('[Unknown current to set:',cmd,']',file=stderr);return False
-      if not dryrun: self.instr.setamp(val/1000,rel=rel)
+      if not dryrun: self.instr.queueset('Iset',val/1000,rel=rel)
     elif cmd[-1:]=='A':
       if help: print('  nn.nnA         set output current');return False
       try: val,rel=self.floatrel(cmd[:-1])
       except: print('[Unknown current to set:',cmd,']',file=stderr);return False
-      if not dryrun: self.instr.setamp(val,rel=rel)
+      if not dryrun: self.instr.queueset('Iset',val,rel=rel)
+
 
+    # software constant power/resistance
+    elif cmd in ['CP','CR']:
+      if help: print(f'  {cmd}:{"watts" if cmd=="CP" else "ohms"}[:secs[:opts]]  constant {"power" if cmd=="CP" else "resistance"} by regulating the current, secs=0 endless')
+      if help: print('          opts:  src=status|query, slew=A/s, imax=A, ki=1/s, off (stop on output off)');return False
+      try:
+        target=float(cmdarr[1])
+        secs=float(cmdarr[2]) if cmdarr[2]!='' else 0
+        src='status';stopoff=False;o={}
+        for x in cmdarr[3].split(','):
+          a=x.strip().lower().split('=')
+          if a[0]=='': continue
+          elif a[0]=='src' and len(a)==2 and a[1] in ['status','query']: src=a[1]
+          elif a[0]=='off': stopoff=True
+          elif a[0] in ['slew','imax','ki'] and len(a)==2: o[a[0]]=float(a[1])
+          else: raise ValueError(x)
+        reg=Regulator(cmd[1],target,**o)
+      except ValueError: print('[Bad regulation parameters:',cmdorig,']',file=stderr);return False
+      if not dryrun: reg.run(self.instr,secs=secs,src=src,stopoff=stopoff or self.instr.stopoff)
+
+    elif cmd=='DISCHARGE':
+      if help: print('  DISCHARGE:amps:vcut[:opts]  discharge test down to cutoff, Ah/Wh integrated from status reports, then report')
+      if help: print('          opts:  check=secs (device counter cross-check, default 60), time=secs (max. duration), log=file (samples CSV)');return False
+      try:
+        amps=float(cmdarr[1]);vcut=float(cmdarr[2])
+        o={};log=None
+        for x in cmdarr[3].split(','):
+          a=x.strip().split('=')
+          if a[0]=='': continue
+          elif a[0].lower()=='log' and len(a)==2: log=a[1]
+          elif a[0].lower()=='check' and len(a)==2: o['check']=float(a[1])
+          elif a[0].lower()=='time' and len(a)==2: o['maxtime']=float(a[1])
+          else: raise ValueError(x)
+        test=DischargeTest(amps,vcut,**o)
+      except ValueError: print('[Bad discharge parameters:',cmdorig,']',file=stderr);return False
+      if not dryrun: self.storeresult('discharge',test.run(self.instr,log=log),amps=amps,vcut=vcut)
+
+    elif cmd=='IR':
+      if help: print('  IR:low:high[:opts]  internal resistance from current steps between low and high amps')
+      if help: print('          opts:  n=pulses (default 5), settle=secs at each level before the step (default 0.5)');return False
+      try:
+        lo=float(cmdarr[1]);hi=float(cmdarr[2])
+        o={}
+        for x in cmdarr[3].split(','):
+          a=x.strip().lower().split('=')
+          if a[0]=='': continue
+          elif a[0]=='n' and len(a)==2: o['pulses']=int(a[1])
+          elif a[0]=='settle' and len(a)==2: o['settle']=float(a[1])
+          else: raise ValueError(x)
+        test=IRTest(lo,hi,**o)
+      except ValueError: print('[Bad IR parameters:',cmdorig,']',file=stderr);return False
+      if not dryrun: self.storeresult('ir',test.run(self.instr),ilow=lo,ihigh=hi)
+
+    elif cmd=='SWEEP':
+      if help: print('  SWEEP:start:stop:step[:dwell[:opts]]  I-V sweep, currents in A, dwell in secs before each measurement; CSV table')
+      if help: print('          opts:  log=file (table), vmin=V (stop below), fold=fraction (stop when current < fraction of set)');return False
+      try:
+        o={};log=None
+        if cmdarr[4]!='': o['dwell']=float(cmdarr[4])
+        for x in (cmdarr[5] if len(cmdarr)>5 else '').split(','):
+          a=x.strip().split('=')
+          if a[0]=='': continue
+          elif a[0].lower()=='log' and len(a)==2: log=a[1]
+          elif a[0].lower() in ['vmin','fold'] and len(a)==2: o[a[0].lower()]=float(a[1])
+          else: raise ValueError(x)
+        test=SweepTest(float(cmdarr[1]),float(cmdarr[2]),float(cmdarr[3]),**o)
+      except ValueError as e: print('[Bad sweep parameters:',cmdorig,e,']',file=stderr);return False
+      if not dryrun:
+        out=None if log==None else open(log,'w')
+        try: self.storeresult('sweep',test.run(self.instr,out),start=test.points[0],stop=test.points[-1])
+        finally:
+          if out!=None: out.close()
+
+    elif cmd=='FLEET':
+      if help: print('  FLEET[:opts]   control devices from config dev.<id>=, group.<name>=; stdin lines "<id|group|*> <command>..."')
+      if help: print('          opts:  J=JSON, L=print status reports');return False
+      if dryrun: self.fleetopts=cmdarr[1].upper()
+
+    # serve commands from other invocations, everything after it is ignored; run part in handlecommands
+    elif cmd=='DAEMON':
+      if help: print('  DAEMON[:sock]  keep the connection, serve commands of other invocations over unix socket');return False
+    elif cmd=='SCPI':
+      if help: print('  SCPI[:port[:addr]]  SCPI gateway on raw TCP, default port 5025; everything after it is ignored');return False
+      if cmdarr[1]!='':
+        try: int(cmdarr[1])
+        except: print('[Unknown SCPI port:',cmdorig,']');return False
+    elif cmd=='NODAEMON':
+      if help: print('  NODAEMON       do not pass the commands to a running daemon');return False
 
     # take commands from stdin, help-only here
     elif cmd in ['STDIN']:
@@ -908,24 +3499,19 @@ class PowerLoad:
         except: print('[Unknown count:',cmdorig,']');return False
         if cmdarr[2].upper()=='OFF': stopoff=True
       if not dryrun:
-        while True:
-          if not singlelisten:
-            s=self.timeout_stdin()
-            if s:
-              #print('STDIN:',s)
-              if s.upper()[:6]=='LISTEN': print('ERR: cannot recurse LISTEN',file=stderr);continue
-              if self.handlecommand(s,True): self.handlecommand(s,False) # check validity, execute if good
-          self.instr.recvdata()
-          if self.instr.gotupdate():
-            #print(self.instr.state,self.instr.cmd_readstate())
-            #d=self.instr.state.copy()
-            #d.update(self.instr.cmd_readstate())
-            #print(d)
-            self.instr.printstate(opts=cmdarr[1])
-            if singlelisten: break
-            cnt-=1
-            if cnt==0: break
-            if (stopoff or self.instr.stopoff) and self.instr.out==0: break
+        def online(s):
+          if s==None: return False # stdin closed, keep listening
+          if s.upper()[:6]=='LISTEN': print('ERR: cannot recurse LISTEN',file=stderr);return False
+          op=self.stdinop(s)
+          if op!=None: op()
+        def onupdate():
+          nonlocal cnt
+          self.instr.printstate(opts=cmdarr[1])
+          if singlelisten: return True
+          cnt-=1
+          if cnt==0: return True
+          return (stopoff or self.instr.stopoff) and self.instr.out==0
+        self.waitevents(online=None if singlelisten else online,onupdate=onupdate)
 
     # output formatting
     elif cmd in ['LINE','ONELINE']:
@@ -936,9 +3522,78 @@ class PowerLoad:
     elif cmd in ['WAIT']:
       if help: print('  WAIT           wait for communication from device');return False
 
+    elif cmd=='PROFILE':
+      if help: print(f'  PROFILE        report startup timing and imports on exit (budget to first send: {STARTUP_BUDGET*1000:.0f} ms)');return False
+
     elif cmd in ['ROBUST']:
-      if help: print('  ROBUST         increase timeouts and retries');return False
-      self.instr.robust=True
+      if help: print('  ROBUST         longer minimum timeouts and more retries, for flaky links');return False
+      self.instr.setpolicy('robust')
+
+    elif cmd=='CACHE':
+      if help: print('  CACHE:secs     max. age of cached values served instead of queries, 0=always query; CACHE:name=secs per field');return False
+      try: self.instr.setcacheage(cmdorig[6:])
+      except: print('[Unknown cache age:',cmdorig,']');return False
+
+    elif cmd=='REC':
+      if help: print('  REC:file       record status packets and query results to binary capture file');return False
+      if cmdorig[4:]=='': print('[No capture file:',cmdorig,']');return False
+      if not dryrun: self.instr.recorder=CaptureWriter(cmdorig[4:])
+
+    elif cmd=='DB':
+      if help: print('  DB:file[:key=val,...]  store status samples to SQLite database as a new run with the metadata (eg. lot=A7,cell=3)');return False
+      try: meta=self.parsemeta(cmdarr[2])
+      except ValueError: print('[Bad run metadata:',cmdorig,']');return False
+      if cmdarr[1]=='': print('[No database file:',cmdorig,']');return False
+      if dryrun: self.dbspec=(cmdarr[1],meta)
+      elif self.instr.store==None:
+        self.instr.store=SampleStore(cmdarr[1])
+        self.instr.storerun=self.instr.store.newrun(device=self.conf.get('host',self.conf.get('serport',self.conf.get('sim',''))),**meta)
+        if self.verbrun: print('DB: run',self.instr.storerun,'in',cmdarr[1],file=stdlog)
+
+    elif cmd=='DBRUNS':
+      if help: print('  DBRUNS:file[:key=val,...]  list runs in database with metadata and results, only matching ones if given');return False
+      try: where=self.parsemeta(cmdarr[2])
+      except ValueError: print('[Bad run filter:',cmdorig,']');return False
+      self.dbruns(cmdarr[1],where)
+
+    elif cmd=='DBEXPORT':
+      if help: print('  DBEXPORT:file:run[:from[:to]]  samples of a run as CSV, time range in secs from run start');return False
+      try: run=int(cmdarr[2]);t0=float(cmdarr[3]) if cmdarr[3]!='' else None;t1=float(cmdarr[4]) if len(cmdarr)>4 and cmdarr[4]!='' else None
+      except ValueError: print('[Bad run or time:',cmdorig,']');return False
+      self.dbexport(cmdarr[1],run,t0,t1)
+
+    elif cmd=='METRICS':
+      if help: print(f'  METRICS[:port[:addr]]  serve counters and histograms on http://addr:port/metrics (default {DEFAULT_METRICSPORT}, 127.0.0.1)');return False
+      a=(cmdorig[8:]+'::').split(':')
+      try: port=int(a[0]) if a[0]!='' else DEFAULT_METRICSPORT
+      except: print('[Bad metrics port:',cmdorig,']');return False
+      if not dryrun:
+        try: metrics.serve(port,a[1] or '127.0.0.1')
+        except OSError as e: print('ERR: metrics server:',e,file=stderr)
+
+    elif cmd=='METRICSFILE':
+      if help: print('  METRICSFILE:file[:secs]  dump metrics as JSON to file every secs (default 10)');return False
+      a=(cmdorig[12:]+':').split(':')
+      if a[0]=='': print('[No metrics file:',cmdorig,']');return False
+      try: secs=float(a[1]) if a[1]!='' else 10
+      except: print('[Bad metrics interval:',cmdorig,']');return False
+      if not dryrun: metrics.dumpevery(a[0],secs)
+
+    elif cmd=='ROLLUP':
+      if help: print('  ROLLUP         keep min/mean/max history of status reports at 1s/10s/1m/15m, for HIST (always on in DAEMON)');return False
+      if not dryrun and self.instr.rollup==None: self.instr.rollup=Rollup()
+
+    elif cmd=='HIST':
+      if help: print('  HIST:res:span[:J]  print history at resolution 1s, 10s, 1m or 15m for the last span (eg. 90s, 30m, 24h, 7d); J=JSON lines');return False
+      if cmdarr[1].lower() not in Rollup.LEVELS: print('[Unknown resolution:',cmdorig,'; use',','.join(Rollup.LEVELS),']',file=stderr);return False
+      try: span=Rollup.parsespan(cmdarr[2] or '1h')
+      except ValueError: print('[Unknown span:',cmdorig,']',file=stderr);return False
+      if not dryrun:
+        if self.instr.rollup==None: print('ERR: no history, use ROLLUP or DAEMON',file=stderr);return True
+        from json import dumps
+        for r in self.instr.rollup.history(cmdarr[1].lower(),span):
+          if cmdarr[3].upper()=='J': print(dumps(r))
+          else: print(r)
 
     elif cmd in ['OFFOFF']:
       if help: print('  OFFOFF         switch output off on program exit');return False
@@ -962,10 +3617,7 @@ class PowerLoad:
         try: secs=float(s)
         except: print('['+cmd+': Unknown delay to set:',s,']');return False
       else: secs=1
-      if not dryrun:
-        for x in range(0,int(secs/0.1)):
-          sleep(0.1)
-          self.instr.recvdata()
+      if not dryrun: self.waitevents(until=monotonic()+secs)
 
     # perform loop, help and validation only here
     elif cmd=='LOOP':
@@ -995,28 +3647,27 @@ class PowerLoad:
       if help: print('  RAWPROTO:xx[:xx:xx:xx:xx]   raw Atorch protocol send, cmd + 4 payloads');return False
       try: barr=bytearray.fromhex((cmdorig[9:]+' 00 00 00 00 00').replace(':',' '))[:5]
       except: print('[cannot interpret hex string: "'+cmdorig+'" ]');return False
-      if not dryrun: self.instr.send_atorch_raw(barr[0],d=barr[1:])
+      if not dryrun: self.instr.invalidate();self.instr.send_atorch_raw(barr[0],d=barr[1:])
 
     elif cmd=='RAWPX100':
       if help: print('  RAWPX100:xx[:xx:xx]         raw PX100 protocol send, cmd + 2 payloads');return False
       try: barr=bytearray.fromhex((cmdorig[9:]+' 00 00 00').replace(':',' '))[:3]
       except: print('[cannot interpret hex string: "'+cmdorig+'" ]');return False
-      if not dryrun: self.instr.send_px100cmd_raw(barr[0],d=barr[1:])
+      if not dryrun: self.instr.invalidate();self.instr.send_px100cmd_raw(barr[0],d=barr[1:])
 
     elif cmd=='RAWSEND':
       if help: print('  RAWSEND:xx[:xx:xx:...]      raw serial protocol data send');return False
       try: barr=bytearray.fromhex(cmdorig[8:].replace(':',' '))
       except: print('[cannot interpret hex string: "'+cmdorig+'" ]');return False
       if not dryrun:
+        self.instr.invalidate()
         self.instr.showpacket(barr,name='SEND:',force=self.instr.verbcomsr)
         self.instr.comm.send(barr)
-        sleep(0.1)
-        self.instr.waitreply(retries=30)
+        self.instr.waitreply(timeout=1.5)
 
     elif cmd=='NORETRY':
       if help: print('  NORETRY                     do not retry timeouted commands');return False
-      self.instr.retriescmd=1
-      self.instr.retries=1
+      self.instr.setpolicy('noretry')
 
     elif cmd in ['STATE','STAT','STATUS']:
       if help: print('  STATE[:opts]   print setting state in JSON format')
@@ -1036,13 +3687,15 @@ class PowerLoad:
 
   # list help of commands
   def helpcommands(self):
-    helparr=['ON','OFF',
-             '-','xVCUT','xMA','xA',
+    helparr=['ON','OFF','FLUSH','NOQUEUE',
+             '-','xVCUT','xMA','xA','CP','CR','DISCHARGE','IR','SWEEP',
              '-','QV','QMV','QA','QMA','QTI','QVCUT',
              '-','QAH','QMAH','QWH','QMWH','RESET',
-             '-','STAT','JSTAT','LISTEN',
-             '-','TCP=','PORT=','WAIT','ROBUST','OFFOFF','STOPOFF',
-             '-','STDIN','LOOP:','SLEEP','VERB','LINE','TYPE','CFGFILE',
+             '-','STAT','JSTAT','LISTEN','REC','PLAY','ROLLUP','HIST','DB','DBRUNS','DBEXPORT','METRICS','METRICSFILE',
+             '-','TCP=','PORT=','SIM=','WAIT','PROFILE','ROBUST','CACHE','OFFOFF','STOPOFF',
+             '-','FLEET','DEV=',
+             '-','STDIN','LOOP:','SLEEP','VERB','LINE','TYPE','CFGFILE','DECODE',
+             '-','DAEMON','NODAEMON','SCPI',
              '-','RAWPROTO','RAWPX100','RAWSEND','NORETRY']
     print('Atorch DL24 artificial control')
     print('Usage:',argv[0],'<command> [command]...')
@@ -1051,7 +3704,8 @@ class PowerLoad:
     for x in helparr: self.handlecommand(x.upper(),dryrun=True,help=True)
     print()
     print('For volt and amp setting, prefixing the value with + or - marks it as relative, to be added/subtracted to the current value')
-    print('Commands are executed in sequence. Writes are cached and grouped together to minimize bus transactions.')
+    print('Commands are executed in sequence. Writes are cached and grouped together to minimize bus transactions:')
+    print('current, cutoff and output settings wait until FLUSH, the next query, or 0.2 s; only the last value of each is written and verified.')
     print('Commands are case-insensitive.')
     print('Command "-" forces a newline into output.')
 
@@ -1063,39 +3717,116 @@ class PowerLoad:
       if not self.handlecommand(x,True,mainhelp=True): ok=False
     return ok
 
-  # dryrun of commands to check validity, then run live
-  def handlecommands(self,cmds):
-    #print("COMMANDS:",cmds)
-#    for x in cmds: self.handlecommand(x,False)
+  # compile commands to a program, a list of operations; LOOP takes the rest of the list as its body, compiled once
+  # cmds must be verified already
+  def compilecommands(self,cmds):
+    prog=[]
     for t in range(0,len(cmds)):
       cmd=cmds[t].upper()
-      #print('CMD:',cmd)
-      counter=-1 # endless
-      # recursive running of loop
       if cmd[:5]=='LOOP:':
-        if len(cmd)>5: counter=int(cmd[5:]) # error check already done in dryrun parse
-        while counter!=0:
-          counter-=1
-          self.handlecommands(cmds[t+1:])
-          #if counter==0: break
+        prog.append(self.oploop(int(cmd[5:]) if len(cmd)>5 else -1,self.compilecommands(cmds[t+1:])))
+        break
+
+      elif cmd[:6]=='DAEMON':
+        prog.append(lambda arg=cmds[t][7:]: self.rundaemon(arg))
+        break
+
+      elif cmd[:4]=='SCPI':
+        a=(cmds[t]+'::').split(':')
+        prog.append(lambda port=int(a[1]) if a[1]!='' else DEFAULT_SCPIPORT,addr=a[2]: self.runscpi(port,addr))
         break
 
       # from now, everything comes from stdin
       elif cmd=='STDIN':
-        #print('STDIN')
-        while True:
-          self.instr.recvdata()
-          s=self.timeout_stdin()
-          if s==False: break # pipe closed
-          if s!='':
-            #print('STDIN:',s)
-            #if s.upper()[:6]=='LISTEN': print('ERR: cannot recurse LISTEN',file=stderr);continue
-            if s.upper()=='STDIN':      print('ERR: cannot recurse STDIN',file=stderr);continue
-            if self.handlecommand(s,True): self.handlecommand(s,False,singlelisten=True) # check validity, execute if good
+        prog.append(self.runstdin)
+        break
 
       else:
-        if self.qend==' ' and cmd[:5]=='SLEEP': print()
-        self.handlecommand(cmd,False,verb=False)
+        op=self.compilecmd(cmds[t],checked=True)
+        if cmd[:5]=='SLEEP':
+          def sleepop(op=op):
+            if self.qend==' ': print()
+            op()
+          prog.append(sleepop)
+        else: prog.append(op)
+    return prog
+
+  def oploop(self,counter,body):
+    def loop():
+      n=counter # endless if negative
+      while n!=0:
+        n-=1
+        for op in body: op()
+    return loop
+
+  # compile one command to an operation, None if invalid; checked: validated already by verifycommands()
+  # frequent commands are bound directly with parsed arguments, the others validated once and run by handlecommand()
+  def compilecmd(self,cmdorig,checked=False,singlelisten=False):
+    cmdarr=(cmdorig+':::').split(':')
+    cmd=cmdarr[0].upper()
+    op=self.bindcmd(cmd,cmdarr)
+    if op==None:
+      if not checked and not self.handlecommand(cmdorig,True): return None
+      return lambda: self.handlecommand(cmdorig,False,verb=False,singlelisten=singlelisten)
+    def run():
+      if self.verbcmd: print('CMD:',cmdorig,file=stdlog)
+      self.lastcmd=cmd
+      op()
+    return run
+
+  # direct operation for a frequent command, None for the rest and for bad arguments (handlecommand() reports them)
+  def bindcmd(self,cmd,cmdarr):
+    i=self.instr
+    q={'QV':(i.cmd_getvolt,{}),'QA':(i.cmd_getamp,{}),'QI':(i.cmd_getamp,{}),'QMV':(i.cmd_getvolt,{'div':1}),'QMA':(i.cmd_getamp,{'div':1}),
+       'QVCUT':(i.cmd_getsetcutoff,{}),'QOUT':(i.cmd_getonoff,{}),'QTI':(i.cmd_gettemp,{}),
+       'QAH':(i.cmd_getah,{'div':1000}),'QMAH':(i.cmd_getah,{'div':1}),'QWH':(i.cmd_getwh,{'div':1000}),'QMWH':(i.cmd_getwh,{'div':1})}
+    if cmd in q:
+      f,kw=q[cmd]
+      return lambda: print(f(**kw),end=self.qend)
+    ops={'ON':lambda: i.queueset('out',1),'OFF':lambda: i.queueset('out',0),'TOGGLE':i.setTOGGLE,'RESET':i.cmd_resetcounters,
+         'FLUSH':i.flush,'-':print}
+    if cmd in ops: return ops[cmd]
+    if cmd in ['STATE','STAT','STATUS']: return lambda o=cmdarr[1]: i.printstate(opts=o)
+    if cmd in ['JSTATE','JSTAT','JSTATUS','STATEJ','STATJ','STATUSJ']: return lambda o='J'+cmdarr[1]: i.printstate(opts=o)
+    try:
+      if cmd[:5]=='SLEEP':
+        s=cmd[5:]+cmdarr[1]
+        secs=float(s) if s!='' else 1
+        return lambda: self.waitevents(until=monotonic()+secs)
+      if cmd[-4:]=='VCUT':
+        val,rel=self.floatrel(cmd[:-4])
+        if rel: return None
+        return lambda: i.queueset('Vcut',val)
+      if cmd[-2:]=='MA':
+        val,rel=self.floatrel(cmd[:-2])
+        return lambda: i.queueset('Iset',val/1000,rel=rel)
+      if cmd[-1:]=='A':
+        val,rel=self.floatrel(cmd[:-1])
+        return lambda: i.queueset('Iset',val,rel=rel)
+    except (ValueError,IndexError): return None
+    return None
+
+  # compiled stdin lines (self.stdinops), repeated lines are not parsed again
+  def stdinop(self,s):
+    op=self.stdinops.get(s)
+    if op==None:
+      op=self.compilecmd(s,singlelisten=True)
+      if op==None: return None
+      if len(self.stdinops)>=256: self.stdinops.clear()
+      self.stdinops[s]=op
+    return op
+
+  def runstdin(self):
+    def online(s):
+      if s==None: return True # pipe closed
+      if s.upper()=='STDIN': print('ERR: cannot recurse STDIN',file=stderr);return False
+      op=self.stdinop(s)
+      if op!=None: op()
+    self.waitevents(online=online)
+
+  # run commands; verifycommands() first
+  def handlecommands(self,cmds):
+    for op in self.compilecommands(cmds): op()
 
 
 
@@ -1105,12 +3836,217 @@ class PowerLoad:
 
   conf={}
   configfilename=None
+  fleetopts=None
+  dbspec=None       # (file,metadata) from DB:
+
+  # commands that have to run in the invoking process, not through the daemon
+  DAEMON_LOCAL=['DAEMON','NODAEMON','SCPI','REC','PLAY','DB','DBRUNS','DBEXPORT','STDIN','LISTEN','FLEET','TCP=','PORT=','SIM=','DEV=','CFGFILE','DECODE','HELP','LIST','?','-H','--HELP']
+
+  def daemonsockname(self,path=''):
+    from os.path import expanduser
+    if path=='': path=self.conf.get('daemonsock','~/.'+self.getprocessbarename()+'.sock')
+    return expanduser(path)
+
+  # pass commands to a running daemon; returns exit code, None if there is no daemon to talk to
+  def daemonclient(self,cmds):
+    for x in cmds:
+      c=x.upper()
+      if c=='LOOP:' or any(c==y or (y[-1]=='=' and c[:len(y)]==y) or c[:len(y)+1]==y+':' for y in self.DAEMON_LOCAL): return None
+    s=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try: s.connect(self.daemonsockname())
+    except OSError: s.close();return None
+    from json import dumps,loads
+    s.sendall((dumps({'cmds':cmds})+'\n').encode())
+    res=b''
+    while True:
+      d=s.recv(65536)
+      if d==b'': break
+      res+=d
+    s.close()
+    try: r=loads(res)
+    except ValueError: print('ERR: bad reply from daemon',file=stderr);return 1
+    print(r['out'],end='')
+    if r['err']!='': print(r['err'],end='',file=stderr)
+    return r['rc']
+
+  # run one client job: validate, execute, capture stdout and stderr
+  def daemonjob(self,cmds):
+    global stdlog,stderr
+    from io import StringIO
+    from contextlib import redirect_stdout
+    out=StringIO();err=StringIO()
+    oldlog,olderr=stdlog,stderr
+    stdlog=err if stdlog is stderr else stdlog
+    stderr=err
+    qend=self.qend;rc=0
+    try:
+      with redirect_stdout(out):
+        if not self.verifycommands(cmds): print('Command error.',file=stderr);rc=1
+        else: self.handlecommands(cmds)
+        self.instr.flush() # errors go to this client
+        if self.lastcmd[:5]=='SLEEP' and self.qend==' ': print()
+    except SystemExit as e: rc=e.code if isinstance(e.code,int) else 1
+    except Exception as e: print('ERR:',e,file=stderr);rc=1
+    finally:
+      stdlog,stderr=oldlog,olderr
+      self.qend=qend
+    return {'out':out.getvalue(),'err':err.getvalue(),'rc':rc}
+
+  def runscpi(self,port=DEFAULT_SCPIPORT,addr=''):
+    s=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    s.bind((addr,port))
+    s.listen(16)
+    if self.verbrun: print('SCPI: listening on',addr,port,file=stdlog)
+    ScpiGateway(self.instr,EventLoop(),s).run()
+
+  # own the device connection, serve jobs from other invocations one by one over a unix socket
+  def rundaemon(self,path=''):
+    import os,signal
+    from json import dumps,loads
+    signal.signal(signal.SIGTERM,lambda n,f: exit(0)) # clean up the socket on kill too
+    path=self.daemonsockname(path)
+    s=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    if os.path.exists(path):
+      try: s.connect(path);print('ERR: daemon already running on',path,file=stderr);s.close();return
+      except OSError: os.unlink(path) # stale
+      s.close();s=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    s.bind(path)
+    s.listen(16)
+    if self.verbrun: print('DAEMON: listening on',path,file=stdlog)
+    if self.instr.rollup==None: self.instr.rollup=Rollup()
+    loop=EventLoop()
+    jobs=[]
+    def online(c,line):
+      try: cmds=loads(line)['cmds']
+      except (ValueError,KeyError,TypeError): srv.send(c,dumps({'out':'','err':'ERR: bad request\n','rc':1}));srv.finish(c);return
+      jobs.append((c,cmds))
+    srv=LineServer(loop,s,online)
+    key=None
+    try:
+      while True:
+        key=loop.watchport(self.instr.comm,self.instr.recvdata,key)
+        loop.runonce(loop.porttimeout(self.instr.comm))
+        self.instr.recvdata()
+        while jobs: # one transaction queue, jobs run to completion in arrival order
+          c,cmds=jobs.pop(0)
+          if c not in srv.conns: continue
+          srv.send(c,dumps(self.daemonjob(cmds))+'\n')
+          srv.finish(c)
+    finally:
+      srv.shutdown()
+      loop.close()
+      try: os.unlink(path)
+      except OSError: pass
+
+  # run fleet mode with devices and groups from config
+  def runfleet(self):
+    fleet=Fleet(self.fleetopts)
+    fleet.verb=self.verbrun
+    for k,v in self.conf.items():
+      if k[:4]=='dev.': fleet.adddev(k[4:],v)
+    for k,v in self.conf.items():
+      if k[:6]!='group.': continue
+      ids=[x.strip() for x in v.split(',') if x.strip()!='']
+      bad=[x for x in ids if x not in fleet.devs]
+      if bad: print('ERR: unknown devices in',k,':',bad,file=stderr);exit(1)
+      fleet.addgroup(k[6:],ids)
+    if fleet.devs=={}:
+      print('ERROR: no fleet devices, use DEV=id=... or dev.<id>= in config',file=stderr)
+      exit(1)
+    if self.dbspec!=None: # one database, one run per device
+      store=SampleStore(self.dbspec[0])
+      for id,dev in fleet.devs.items():
+        dev.store=store
+        dev.storerun=store.newrun(device=fleet.specs[id],name=id,**self.dbspec[1])
+    fleet.run()
+    if self.dbspec!=None:
+      for dev in fleet.devs.values(): store.endrun(dev.storerun)
+      store.close()
 
   def getprocessbarename(self):
     cmdn=('/'+argv[0]).split('/')[-1]
     if cmdn[-3:]=='.py': cmdn=cmdn[:-3]
     return cmdn
 
+  # decode a raw byte capture (eg. cat /dev/rfcomm0 >file) to CSV on stdout, runs without the device
+  def decodefile(self,fn,adu=None):
+    import numpy as np
+    from sys import stdout
+    from time import perf_counter
+    try:
+      with open(fn,'rb') as f: data=f.read()
+    except Exception as e:
+      print('DECODE:FAIL:',e,file=stderr)
+      exit(1)
+    t=perf_counter()
+    a=decode_status_frames(data,adu=adu)
+    t=perf_counter()-t
+    np.savetxt(stdout,a,fmt='%g',delimiter=',',header=','.join(a.dtype.names),comments='')
+    if self.verbrun: print(f'DECODE: {len(a)} packets, {len(data)} bytes, {t:.3f} s',file=stdlog)
+    exit(0)
+
+  # time from epoch seconds or YYYYMMDDTHHMMSS local time, None for empty
+  def parsetime(self,s):
+    if s=='': return None
+    try: return float(s)
+    except ValueError: pass
+    from datetime import datetime
+    return datetime.strptime(s,'%Y%m%dT%H%M%S').timestamp()
+
+  # key=val,... to dict, numbers as numbers
+  def parsemeta(self,s):
+    meta={}
+    for x in s.split(','):
+      if x.strip()=='': continue
+      k,v=x.split('=',1)
+      try: v=float(v) if '.' in v else int(v)
+      except ValueError: pass
+      meta[k.strip()]=v
+    return meta
+
+  # test results go to the metadata of the current run
+  def storeresult(self,test,res,**params):
+    if self.instr.store==None or res==None: return
+    self.instr.store.setmeta(self.instr.storerun,test=test,**params,**res)
+
+  # list runs of a database, runs without the device
+  def dbruns(self,fn,where):
+    from json import dumps
+    try: db=SampleStore(fn)
+    except Exception as e:
+      print('DBRUNS:FAIL:',e,file=stderr)
+      exit(1)
+    for a in db.runs(**where): print(dumps(a))
+    db.close()
+    exit(0)
+
+  # export samples of a run as CSV, runs without the device
+  def dbexport(self,fn,run,t0=None,t1=None):
+    try: db=SampleStore(fn)
+    except Exception as e:
+      print('DBEXPORT:FAIL:',e,file=stderr)
+      exit(1)
+    r=db.db.execute('SELECT started FROM runs WHERE id=?',(run,)).fetchone()
+    if r==None: print('DBEXPORT:FAIL: no run',run,file=stderr);exit(1)
+    ts=r[0]
+    print('t,V,A,Ah,Wh,temp,runtime')
+    for x in db.samples(run,None if t0==None else ts+t0,None if t1==None else ts+t1):
+      print(f'{x[0]-ts:.3f},'+','.join('' if v==None else f'{v:g}' for v in x[1:]))
+    db.close()
+    exit(0)
+
+  # print records of a capture file, runs without the device
+  def playfile(self,fn,t0=None,t1=None):
+    from json import dumps
+    try: r=CaptureReader(fn)
+    except Exception as e:
+      print('PLAY:FAIL:',e,file=stderr)
+      exit(1)
+    for a in r.range(t0,t1): print(dumps(a))
+    r.close()
+    exit(0)
+
   # generate configuration file name from running file name or from name or direct filename
   # TODO: windows compatibility
   def setconfigfilename(self,name=None,filename=None):
@@ -1129,11 +4065,20 @@ class PowerLoad:
 # baudrate=115200
 ## wait for communication from device before sending data
 # waitcomm=1
+## max. age of cached values in seconds, like CACHE:
+# cacheage=5
+## unix socket of the DAEMON
+# daemonsock=~/.dl24.sock
 
 # plain TCP socket
 # host=dt24p.local
 # port=8888
 
+# fleet devices and groups, for FLEET
+# dev.a=tcp:dl24a.local:8888
+# dev.b=/dev/ttyUSB0@9600
+# group.rack1=a,b
+
 # physical port takes precedence if both are defined
 """)
     exit(0)
@@ -1175,32 +4120,30 @@ class PowerLoad:
   # initialize port from configuration in self.conf
   def initport(self):
     #global comm,port,self.instr
-    if 'serport' in self.conf:
-      port=self.conf['serport']
-      baud=DEFAULT_BAUDRATE if 'baudrate' not in self.conf else self.cfgint(self.conf['baudrate'],default=DEFAULT_BAUDRATE)
-      self.instr.initport(LowLevelSerPort(port,baud))
-      self.default_minimize=False
-    elif 'host' in self.conf:
-      host=self.conf['host']
-      port=DEFAULT_TCPPORT if 'port' not in self.conf else self.cfgint(self.conf['port'],default=DEFAULT_TCPPORT)
-      self.instr.initport(LowLevelTcpPort(host,port))
-      self.default_minimize=True
+    for name,key,factory,minimize in TRANSPORTS:
+      if key in self.conf:
+        self.instr.initport(factory(self.conf,self.cfgint))
+        self.default_minimize=minimize
+        break
     else:
       print('ERROR: unknown serial port or TCP host',file=stderr)
-      print('Use TCP=<host>[:port] or PORT=[/dev/tty...]',file=stderr)
+      print('Use TCP=<host>[:port] or PORT=[/dev/tty...] or SIM=[opts]',file=stderr)
       exit(1)
+    if 'cacheage' in self.conf:
+      try: self.instr.setcacheage(self.conf['cacheage'])
+      except ValueError: print('Configfile error: invalid cacheage "'+self.conf['cacheage']+'"',file=stderr)
 
 
 
   def setverb(self,opts='',help=False):
     def setverbopts(opts):
       #if opts=='': opts='L'
-      pload.verbrun=True
+      self.verbrun=True
       if 'C' in opts: self.instr.verbcomsr=True
       if 'D' in opts: self.instr.verbcom=True
       if 'M' in opts: self.verbcmd=True
       if self.instr.comm!=None:
-        if 'P' in opts: self.instr.comm.verbconn=True;pload.instr.comm.verbport=True
+        if 'P' in opts: self.instr.comm.verbconn=True;self.instr.comm.verbport=True
 
     if help:
       print('          opts:  P=port, C=communication, D=dataflow, M=commands');return
@@ -1218,12 +4161,21 @@ class PowerLoad:
 #######################################
 
 
-if __name__=="__main__":
+def main():
+  global pload
   cmds=argv[1:]
+  profile=None
+  if any(x.upper()=='PROFILE' for x in cmds):
+    profile=StartupProfile()
+    profile.hookimports()
+    import atexit
+    atexit.register(profile.report)
+    profile.mark('main')
 
   pload=PowerLoad()
   pload.setverb() # set verbose flags
   pload.readconf() # set config file
+  if profile: profile.mark('config read')
 
   if len(cmds)==1 and (cmds[0][:4].upper()=='TCP=' or cmds[0][:5].upper()=='PORT='): cmds.append('STATE')
   elif cmds==[]: cmds=['STATE']
@@ -1232,10 +4184,21 @@ if __name__=="__main__":
     print(cmds)
     print('Command error.',file=stderr)
     exit(1)
+  if profile: profile.mark('commands verified')
+
+  rc=pload.daemonclient(cmds)
+  if rc!=None:
+    if profile: profile.mark('daemon job done')
+    exit(rc)
+
+  if pload.fleetopts!=None:
+    pload.runfleet()
+    exit(0)
 
   # now we read the config, processed parameters by a dry run, and know the port to use
   pload.initport()
   pload.setverb() # set verbose flags again, now for port
+  if profile: profile.hooksend(pload.instr.comm)
 
 
   #if pload.isparm('VERB'):    pload.instr.verblnk=True
@@ -1245,6 +4208,7 @@ if __name__=="__main__":
 
   #if pload.instr.verblnk: print('opening port',file=stdlog)
   pload.instr.connect()
+  if profile: profile.mark('connected')
   if pload.isparm('WAIT') or ('waitcomm' in pload.conf and pload.conf['waitcomm']=='1'):
     if pload.verbrun:
       print('waiting for incoming data',file=stdlog)
@@ -1262,3 +4226,5 @@ if __name__=="__main__":
       pload.instr.close()
 
 
+if __name__=="__main__":
+  main()